@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+# static structure of a program: basic blocks, the control flow graph with
+# call and return edges, dominators and natural loops, and a profiler that
+# only counts block entries
+
+import argparse
+import sys
+
+from assembler import Assembler, UNDEFINED
+
+# edges that stay inside a routine, a BL's 'fall' edge goes to where the call returns
+INTRA_EDGES = ('fall', 'jump', 'branch')
+
+
+class BasicBlock(object):
+    def __init__(self, index, start, end):
+        # instructions start to end (inclusive), edges are (kind, block index)
+        self.index = index
+        self.start = start
+        self.end = end
+        self.successors = []
+        self.predecessors = []
+
+    def __len__(self):
+        return self.end - self.start + 1
+
+    def __repr__(self):
+        return 'BasicBlock({}, {}-{})'.format(self.index, self.start, self.end)
+
+
+class Loop(object):
+    def __init__(self, header):
+        # a natural loop, blocks includes the header
+        self.header = header
+        self.blocks = {header}
+        self.back_edges = []
+        self.parent = None
+        self.children = []
+
+    @property
+    def depth(self):
+        return 1 if self.parent is None else self.parent.depth + 1
+
+    def __repr__(self):
+        return 'Loop(header={}, blocks={})'.format(self.header, sorted(self.blocks))
+
+
+class ControlFlowGraph(object):
+    def __init__(self, program):
+        self.program = program
+        instrs = program.instrs
+        n = len(instrs)
+
+        # a block starts at the beginning, at every label and after every branch or STOP
+        leaders = {0} | set(program.label_lines)
+        for pc in range(n):
+            if self.is_terminator(instrs[pc]) and pc + 1 < n:
+                leaders.add(pc + 1)
+        starts = sorted(leader for leader in leaders if leader < n)
+        self.blocks = [BasicBlock(i, start, end - 1) for i, (start, end) in enumerate(zip(starts, starts[1:] + [n]))]
+        self.block_of = [0] * n
+        for block in self.blocks:
+            for pc in range(block.start, block.end + 1):
+                self.block_of[pc] = block.index
+
+        # intra routine and call edges
+        self.calls = {}
+        for block in self.blocks:
+            instr = instrs[block.end]
+            name = instr.opcode.name
+            following = block.index + 1 if block.index + 1 < len(self.blocks) else None
+            if name == 'B':
+                self.add_edge(block.index, 'jump', self.block_of[instr.args[0]])
+            elif name == 'BL':
+                callee = self.block_of[instr.args[0]]
+                self.add_edge(block.index, 'call', callee)
+                self.calls.setdefault(callee, []).append(block.index)
+                if following is not None:
+                    self.add_edge(block.index, 'fall', following)
+            elif name in ('CBZ', 'CBNZ') or (instr.opcode.branch and name[:2] == 'B.'):
+                self.add_edge(block.index, 'branch', self.block_of[instr.args[-1]])
+                if following is not None:
+                    self.add_edge(block.index, 'fall', following)
+            elif name in ('BR', 'STOP') or instr.opcode is UNDEFINED and instr.operation[-1] != ':':
+                pass
+            elif following is not None:
+                self.add_edge(block.index, 'fall', following)
+
+        self.find_routines()
+        # BR returns to every place the routines it belongs to are called from
+        for entry, blocks in self.routines.items():
+            for b in sorted(blocks):
+                if instrs[self.blocks[b].end].opcode.name == 'BR':
+                    for caller in self.calls.get(entry, []):
+                        if caller + 1 < len(self.blocks):
+                            self.add_edge(b, 'return', caller + 1)
+
+        self.idom = self.find_dominators()
+        self.loops = self.find_loops()
+
+    @staticmethod
+    def is_terminator(instr):
+        return instr.opcode.branch or instr.opcode.name == 'STOP' or (instr.opcode is UNDEFINED and instr.operation[-1] != ':')
+
+    def add_edge(self, source, kind, target):
+        self.blocks[source].successors.append((kind, target))
+        self.blocks[target].predecessors.append((kind, source))
+
+    def intra_successors(self, b):
+        return [target for kind, target in self.blocks[b].successors if kind in INTRA_EDGES]
+
+    def intra_predecessors(self, b):
+        return [source for kind, source in self.blocks[b].predecessors if kind in INTRA_EDGES]
+
+    def reachable(self, entry):
+        seen = {entry}
+        stack = [entry]
+        while stack:
+            for target in self.intra_successors(stack.pop()):
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return seen
+
+    def find_routines(self):
+        # a routine starts at the beginning of the program or at a BL target, code
+        # that is only reached by unit tests (no BL to it) starts its own routine
+        self.routines = {}
+        if not self.blocks:
+            return
+        entries = [0] + sorted(self.calls)
+        covered = set()
+        for entry in entries:
+            if entry not in self.routines:
+                self.routines[entry] = self.reachable(entry)
+                covered |= self.routines[entry]
+        for block in self.blocks:
+            if block.index not in covered:
+                self.routines[block.index] = self.reachable(block.index)
+                covered |= self.routines[block.index]
+
+    def find_dominators(self):
+        # immediate dominator of every block (None for routine entries), with the
+        # iterative algorithm of Cooper, Harvey and Kennedy over routine edges
+        root = -1
+        order = []
+        seen = set()
+        for entry in self.routines:
+            # iterative post order
+            if entry in seen:
+                continue
+            seen.add(entry)
+            stack = [(entry, iter(self.intra_successors(entry)))]
+            while stack:
+                b, successors = stack[-1]
+                for target in successors:
+                    if target not in seen:
+                        seen.add(target)
+                        stack.append((target, iter(self.intra_successors(target))))
+                        break
+                else:
+                    order.append(b)
+                    stack.pop()
+        order.reverse()
+        number = {b: i + 1 for i, b in enumerate(order)}
+        number[root] = 0
+        idom = {root: root}
+        for entry in self.routines:
+            idom[entry] = root
+
+        def intersect(a, b):
+            while a != b:
+                while number[a] > number[b]:
+                    a = idom[a]
+                while number[b] > number[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for b in order:
+                if b in self.routines:
+                    continue
+                preds = [p for p in self.intra_predecessors(b) if p in idom]
+                new = preds[0]
+                for p in preds[1:]:
+                    new = intersect(p, new)
+                if idom.get(b) != new:
+                    idom[b] = new
+                    changed = True
+        return [None if idom[b.index] == root else idom[b.index] for b in self.blocks]
+
+    def dominates(self, a, b):
+        while b is not None:
+            if a == b:
+                return True
+            b = self.idom[b]
+        return False
+
+    def find_loops(self):
+        # every edge to a block that dominates its source closes a natural loop,
+        # loops with the same header are merged and nested by containment
+        loops = {}
+        for block in self.blocks:
+            for target in self.intra_successors(block.index):
+                if self.dominates(target, block.index):
+                    loop = loops.setdefault(target, Loop(target))
+                    loop.back_edges.append(block.index)
+                    stack = [block.index]
+                    while stack:
+                        b = stack.pop()
+                        if b not in loop.blocks:
+                            loop.blocks.add(b)
+                            stack.extend(self.intra_predecessors(b))
+        loops = sorted(loops.values(), key=lambda loop: len(loop.blocks))
+        for i, loop in enumerate(loops):
+            for outer in loops[i + 1:]:
+                if loop.header in outer.blocks and loop.blocks <= outer.blocks:
+                    loop.parent = outer
+                    outer.children.append(loop)
+                    break
+        return sorted(loops, key=lambda loop: self.blocks[loop.header].start)
+
+    def loop_of(self, b):
+        # the innermost loop a block is in, or None
+        for loop in sorted(self.loops, key=lambda loop: -loop.depth):
+            if b in loop.blocks:
+                return loop
+        return None
+
+    def __str__(self):
+        program = self.program
+        ret = 'Basic Blocks:\n'
+        for block in self.blocks:
+            edges = ', '.join('{} ({})'.format(target, kind) for kind, target in block.successors)
+            ret += '\t{:4d}: {:5d}-{:<5d} lines {}-{}, idom {}, -> {}\n'.format(
+                block.index, block.start, block.end, program.source_lines[block.start],
+                program.source_lines[block.end], self.idom[block.index], edges or '-')
+        ret += 'Routines:\n'
+        for entry, blocks in self.routines.items():
+            ret += '\tblock {} ({}): {} blocks\n'.format(entry, self.label_at(entry) or 'no label', len(blocks))
+        ret += 'Loops:\n'
+        for loop in self.loops:
+            ret += '\t{}header {} ({}): blocks {}\n'.format('  ' * (loop.depth - 1), loop.header,
+                                                         self.label_at(loop.header) or 'no label', sorted(loop.blocks))
+        return ret
+
+    def label_at(self, b):
+        for label, pc in self.program.labels.items():
+            if self.blocks[b].start <= pc <= self.blocks[b].end:
+                return label
+        return None
+
+
+class BlockProfile(object):
+    def __init__(self, cfg):
+        # same interface as branch.BranchModel. only counts where control flow
+        # enters the code (run starts, taken and not taken branches) and where
+        # errors stop it, the count of every instruction is rebuilt from those
+        self.cfg = cfg
+        self.enter = {}
+        self.stop = {}
+
+    def start(self, pc):
+        self.enter[pc] = self.enter.get(pc, 0) + 1
+
+    def finish(self, pc):
+        self.stop[pc] = self.stop.get(pc, 0) + 1
+
+    def record(self, pc, target, taken, conditional=True):
+        # the run continues after the target (a label, or the BL before a return address)
+        pc = target + 1 if taken else pc + 1
+        self.enter[pc] = self.enter.get(pc, 0) + 1
+
+    def instruction_counts(self):
+        # how often every instruction ran, label lines count when they are
+        # passed through like Assembler._line_visit_tracker does
+        counts = [0] * len(self.cfg.block_of)
+        running = 0
+        instrs = self.cfg.program.instrs
+        for block in self.cfg.blocks:
+            if block.index == 0 or self.cfg.is_terminator(instrs[block.start - 1]):
+                # only a block that ends without a branch falls into the next one
+                # without an event, everything else entering here was recorded
+                running = 0
+            for pc in range(block.start, block.end + 1):
+                running += self.enter.get(pc, 0) - self.stop.get(pc, 0)
+                counts[pc] = running
+        return counts
+
+    def block_entries(self):
+        # how often every block ran, counted at its first instruction after its labels
+        counts = self.instruction_counts()
+        label_lines = self.cfg.program.label_lines
+        entries = []
+        for block in self.cfg.blocks:
+            pc = block.start
+            while pc < block.end and pc in label_lines:
+                pc += 1
+            entries.append(counts[pc])
+        return entries
+
+    def report(self):
+        ret = 'Block Profile:\n'
+        for block, count in zip(self.cfg.blocks, self.block_entries()):
+            if count:
+                loop = self.cfg.loop_of(block.index)
+                ret += '\tblock {:4d} ({:5d}-{:<5d}): {:10d}{}\n'.format(
+                    block.index, block.start, block.end, count,
+                    '' if loop is None else ' (loop depth {})'.format(loop.depth))
+        return ret
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", help="name of the LEGv8 program file, several files are linked in order", nargs='+')
+    parser.add_argument("--obj-cache", help="directory to keep assembled files in when linking")
+    parser.add_argument("--profile", help="runs the program and prints how often every block ran", action='store_true')
+    parser.add_argument("--entry", help="label of the routine to call when profiling instead of running from the start")
+    args = parser.parse_args(argv)
+    try:
+        if len(args.input_file) > 1 or args.obj_cache:
+            from linker import build
+            a = Assembler(build(args.input_file, args.obj_cache))
+        else:
+            a = Assembler(open(args.input_file[0], 'r'))
+    except (SyntaxError, ValueError) as e:
+        sys.exit(str(e))
+    cfg = ControlFlowGraph(a.program)
+    print(cfg)
+    if args.profile:
+        profile = BlockProfile(cfg)
+        if args.entry:
+            a.call(args.entry, branches=profile)
+        else:
+            a.run(branches=profile)
+        print(profile.report())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
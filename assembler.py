@@ -24,305 +24,728 @@ SOFTWARE.
 '''
 
 import argparse
+import codecs
+import collections
+import io
+import itertools
 import sys
 import re
 
 MAX_REVISIT_DEPTH = 1000
-
-class Assembler(object):
-    def __init__(self, program):
-        # program should be the name of a file or just plain text
+# innermost calls printed for a stack overflow
+STACK_TRACE_DEPTH = 20
+UNDO_JOURNAL_SIZE = 100000
+
+
+class InfiniteLoopError(RecursionError):
+    # raised when the machine state at a backward branch target repeats exactly,
+    # which means the program can never leave the loop
+    def __init__(self, loop_start, loop_end):
+        self.loop_start = loop_start
+        self.loop_end = loop_end
+        super().__init__('Infinite loop detected between instructions {} and {}'.format(loop_start, loop_end))
+
+
+class StackOverflowError(RecursionError):
+    # raised when the stack or the call nesting grows past the machine's limits
+    def __init__(self, message, pc):
+        self.pc = pc
+        super().__init__(message)
+
+
+class LazyInstructions(object):
+    # the instructions of a lazy Program, a line is only decoded the first
+    # time it is fetched and then kept, so code that never runs costs nothing
+    def __init__(self, lines, decode):
+        self.lines = lines
+        self.decode = decode
+        self.decoded = [None] * len(lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, i):
+        instr = self.decoded[i]
+        if instr is None:
+            instr = self.decoded[i] = self.decode(self.lines[i])
+        return instr
+
+    def __iter__(self):
+        for i in range(len(self.lines)):
+            yield self[i]
+
+
+class Program(object):
+    def __init__(self, program, lazy=False):
+        # program should be the name of a file or just plain text.
+        # a Program is only read after it is assembled, so any number of
+        # machines (Assembler objects) can run it at the same time.
+        # with lazy, only labels are found up front and each instruction is
+        # decoded when it is first reached, syntax errors show up when it runs
         try:
             text = program.read()
         except AttributeError:
             text = program
         # save the program
         self.text = text
-        # setup the registers
-        self.registers = Registers()
 
-        # cleanup the code
+        # cleanup the code, keeping the original line number of every line
         lines = self.text.split('\n')
         lines = self.clean(lines)
 
         # split the code into data and program sections
-        self.raw_asm_lines, data_lines = self.split_sections(lines)
+        asm_lines, data_lines = self.split_sections(lines)
+        raw_asm_lines = [line for _, line in asm_lines]
+
+        if lazy:
+            self.setup(raw_asm_lines, [ln for ln, _ in asm_lines], [d for _, d in data_lines],
+                       [line.upper() for line in raw_asm_lines], ())
+            self.instrs = LazyInstructions(self.raw_asm_lines, self.decode)
+            return
+
+        # process the assembly commands
+        processed = self.preprocess(raw_asm_lines)
+        self.setup(raw_asm_lines, [ln for ln, _ in asm_lines], [d for _, d in data_lines],
+                   processed, [Instruction(asm_line) for asm_line in processed])
+
+    @classmethod
+    def from_parts(cls, text, raw_asm_lines, source_lines, data_lines, asm_lines, instrs, labels=None):
+        # builds a program from already cleaned and preprocessed lines (see linker.py).
+        # with the code labels given, the instructions already have their args and
+        # are not validated again
+        program = cls.__new__(cls)
+        program.text = text
+        program.setup(raw_asm_lines, source_lines, data_lines, asm_lines, instrs, labels)
+        return program
+
+    def setup(self, raw_asm_lines, source_lines, data_lines, asm_lines, instrs, labels=None):
+        self.raw_asm_lines = tuple(raw_asm_lines)
+        self.source_lines = tuple(source_lines)
+
+        # the initial memory image of every machine
+        memory = Memory()
+        for d in data_lines:
+            memory.insert(d)
+        self.data = memory.data
+        self.data_labels = memory.labels
+        self.data_label_ends = memory.label_ends
+        self.data_offset = memory.offset
+
+        resolved = labels is not None
+        self.labels = labels if resolved else self.line_labels(asm_lines)
+        self.label_lines = frozenset(self.labels.values())
+        self.instrs = tuple(instrs)
+        if not resolved:
+            self.validate()
+
+    def machine(self):
+        return Assembler(self)
+
+    @staticmethod
+    def clean(lines):
+        # removes extra lines and comments, returns (line number, line) pairs
+        cleaned = []
+        for ln, line in enumerate(lines, 1):
+            # only append stuff before comments
+            l = line.strip().split('//')[0].strip()
+            # this is to deal with labels on same line as code
+            if len(l.split(':')) > 1:
+                l1 = l.split(':')[0].strip() + ':'
+                l2 = l.split(':')[1].strip()
+                if l1:
+                    cleaned.append((ln, l1))
+                if l2:
+                    cleaned.append((ln, l2))
+            # only put it into lines if its not blank
+            elif l:
+                cleaned.append((ln, l))
+        return cleaned
+
+    @staticmethod
+    def split_sections(lines):
+        instr = []
+        data = []
+        for ln, line in lines:
+            if line[0] == '.':
+                data.append((ln, line))
+            else:
+                instr.append((ln, line))
+        return instr, data
+
+    @staticmethod
+    def preprocess(lines):
+        processed = []
+        for line in lines:
+            instr = Instruction(line)
+            # handles any equivalent instructions, see pseudo_op
+            expand = PSEUDO_OPS.get(instr.operation)
+            if expand is not None:
+                instr.update(*expand(instr))
+            # anything the parser did not understand is kept for validate to report
+            processed.append(str(instr) if not instr.extra else '{} {}'.format(instr, instr.extra))
+        return processed
+
+    def decode(self, line):
+        # decodes and validates one line of a lazy program
+        instr = Instruction(self.preprocess([line])[0])
+        warnings = []
+        errors = self.resolve(instr, self.labels, warnings)
+        for warning in warnings:
+            print(terminal_fonts.to_warning('"{}": {}'.format(line, warning)))
+        if errors:
+            raise SyntaxError(terminal_fonts.to_error('"{}": {}'.format(line, ', '.join(errors))))
+        return instr
+
+    def validate(self):
+        # resolves the operands of every instruction once, so running them needs
+        # no more checks, and reports every problem of the program at once
+        errors, warnings = self.resolve_all(self.instrs, self.labels)
+        self.report(errors, warnings, self.source_lines, self.raw_asm_lines)
+
+    @staticmethod
+    def resolve_all(instrs, labels):
+        # returns the (pc, error) and (pc, warning) pairs of resolving every instruction
+        errors = []
+        warnings = []
+        for pc, instr in enumerate(instrs):
+            found = []
+            errors += [(pc, error) for error in Program.resolve(instr, labels, found)]
+            warnings += [(pc, warning) for warning in found]
+        return errors, warnings
+
+    @staticmethod
+    def report(errors, warnings, source_lines, raw_asm_lines):
+        # prints the warnings and raises one SyntaxError listing every error
+        for pc, warning in warnings:
+            print(terminal_fonts.to_warning('line {}: "{}": {}'.format(source_lines[pc], raw_asm_lines[pc], warning)))
+        if errors:
+            errors = ['line {}: "{}": {}'.format(source_lines[pc], raw_asm_lines[pc], error) for pc, error in errors]
+            raise SyntaxError(terminal_fonts.to_error('{} error(s) in the program:\n{}'.format(len(errors), '\n'.join(errors))))
+
+    @staticmethod
+    def resolve(instr, labels, warnings):
+        # sets instr.args from the opcode's operand format, returns a list of errors
+        # and adds what still works to warnings. labels are the code labels branches can use
+        if instr.operation[-1] == ':':
+            return []
+        opcode = instr.opcode
+        if opcode is UNDEFINED:
+            return ['unknown operation {}'.format(instr.operation)]
+        errors = []
+        if instr.extra:
+            errors.append('unexpected "{}"'.format(instr.extra))
+        operands = instr.operands()
+        expected = len(opcode.operands) + opcode.operands.count('M')
+        if len(operands) != expected:
+            errors.append('expected {} operand(s), got {}'.format(expected, len(operands)))
+            return errors
+        args = []
+        operands = iter(operands)
+        for kind in opcode.operands:
+            operand = next(operands)
+            try:
+                if kind == 'R':
+                    args.append(Program.register(operand))
+                elif kind == 'I':
+                    args.append(Program.immediate(operand, warnings))
+                elif kind == 'M':
+                    offset = next(operands)
+                    if operand[0] != '[' or offset[-1] != ']':
+                        raise ValueError('unknown address: {}, {}'.format(operand, offset))
+                    args.append((Program.register(operand[1:].strip()), Program.immediate(offset[:-1], warnings)))
+                elif kind == 'L':
+                    if operand not in labels:
+                        raise ValueError('undefined label {}'.format(operand))
+                    args.append(labels[operand])
+                else:
+                    args.append(operand)
+            except ValueError as e:
+                errors.append(str(e))
+        instr.set_args(args)
+        return errors
+
+    @staticmethod
+    def register(operand):
+        if operand not in Registers.conversion_dict:
+            raise ValueError('unknown register {}'.format(operand))
+        return Registers.conversion_dict[operand]
+
+    @staticmethod
+    def immediate(operand, warnings):
+        if operand[0] != '#':
+            raise ValueError('unknown immediate value: {}'.format(operand))
+        try:
+            q = int(operand[1:])
+        except ValueError:
+            raise ValueError('unknown immediate value: {}'.format(operand)) from None
+        if q > (2**8):
+            warnings.append('immediate value (#{}) is not able to be processed bare metal'.format(q))
+        return q
+
+    @staticmethod
+    def line_labels(lines):
+        label_lines = {}
+        current_line = 0
+        for line in lines:
+            word = line.split(" ")[0]
+            if (word[-1] == ':'):
+                if word[:-1] in label_lines:
+                    raise ValueError(terminal_fonts.to_error("Line label '{}' occurs more than once".format(word[:-1])))
+                label_lines[word[:-1]] = current_line
+            current_line += 1
+        return label_lines
+
+
+class Assembler(object):
+    def __init__(self, program, lazy=False):
+        # program is a Program, which can be shared between machines,
+        # or the name of a file or just plain text to assemble (see Program for lazy)
+        if isinstance(program, str) or hasattr(program, 'read'):
+            program = Program(program, lazy)
+        self.program = program
+        self.text = program.text
+        self.raw_asm_lines = program.raw_asm_lines
+        self.labels = program.labels
+        self.instrs = program.instrs
+        # setup the registers
+        self.registers = Registers()
 
         # put the data into memory
         self.memory = Memory()
-        for d in data_lines:
-            self.memory.insert(d)
-        # process the assembly commands
-        asm_lines = self.preprocess(self.raw_asm_lines)
-        self.labels = self.line_labels(asm_lines)
-        self.instrs = [Instruction(asm_line) for asm_line in asm_lines]
+        self.memory.data = dict(program.data)
+        self.memory.labels = dict(program.data_labels)
+        self.memory.label_ends = dict(program.data_label_ends)
+        self.memory.offset = program.data_offset
         self.flags = Flags()
         self.console_buffer = ''
         self._line_visit_tracker = {}
+        self.journal = None
+        # sum of the cost of every executed instruction
+        self.cycles = 0
+        self.run_hooks = {}
+        self.mem_trace = None
+        self.shadow = None
+        # where run_for continues, see start
+        self.pc = 0
+        self.halted = False
+        self.started = False
+        self.executed = 0
+        self.loop_states = {}
+        # stack high water marks of the current run, see stack_usage.
+        # the limits are in bytes below the starting SP and in nested BLs
+        self.stack_limit = None
+        self.call_depth_limit = None
+        self.reset_stack_usage()
+        # times a run may execute one instruction before it stops, None for no limit
+        self.max_revisits = MAX_REVISIT_DEPTH
+        # the error that ended the last run early (infinite loop, recursion, stack overflow)
+        self.error = None
+        self.input_device = InputDevice()
+        # python callables that replace the routine at a label, see register_hook
+        self.hooks = {}
+
+    def register_hook(self, label, hook):
+        # hook(assembler) runs instead of the routine whenever it is called with BL,
+        # it works directly on the registers/memory and execution returns to LR
+        self.hooks[label.upper()] = hook
+
+    def remove_hook(self, label):
+        self.hooks.pop(label.upper(), None)
+
+    def active_hooks(self, hooks):
+        # hooks is None for every registered hook, a list of registered labels,
+        # or a dict of label: callable for this run only
+        if hooks is None:
+            return self.hooks
+        if isinstance(hooks, dict):
+            return {label.upper(): hook for label, hook in hooks.items()}
+        return {label.upper(): self.hooks[label.upper()] for label in hooks}
+
+    def set_input(self, source):
+        # source is a file object (file, pipe, stdin) or a string holding the input
+        self.input_device = InputDevice(source)
+
+    def enable_journal(self, max_entries=UNDO_JOURNAL_SIZE):
+        # keeps the values overwritten by the last max_entries instructions
+        # so execution can be stepped backwards
+        self.journal = UndoJournal(max_entries)
+
+    def step_back(self, n=1):
+        # undoes the last n instructions and returns the pc to resume from
+        if self.journal is None:
+            raise ValueError(terminal_fonts.to_error('Undo journal is not enabled'))
+        if not self.journal.entries:
+            raise ValueError(terminal_fonts.to_error('No instructions left to step back'))
+        pc = None
+        for _ in range(min(n, len(self.journal.entries))):
+            pc = self.journal.undo(self)
+        return pc
+
+    def run_back_to(self, pc):
+        # undoes instructions until the state is the one right before
+        # the last execution of the instruction at pc
+        if self.journal is None:
+            raise ValueError(terminal_fonts.to_error('Undo journal is not enabled'))
+        if not self.journal.contains(pc):
+            raise ValueError(terminal_fonts.to_error('Instruction {} is not in the undo journal'.format(pc)))
+        while self.journal.undo(self) != pc:
+            pass
+        return pc
+
+    def breakpoint_prompt(self, instr, pc):
+        # returns (pause at the next instruction, pc to resume from or None)
+        print('{} BREAKPOINT: {} {}'.format(terminal_fonts.BOLD, instr, terminal_fonts.END))
+        print(self.registers)
+        print(self.memory)
+        while True:
+            cmd = input("Press enter to continue, 's' to step, 'b [N]' to step back, 'r PC' to run back to PC: ").split()
+            if not cmd or cmd[0] not in ('s', 'b', 'r'):
+                return False, None
+            if cmd[0] == 's':
+                return True, None
+            try:
+                if cmd[0] == 'b':
+                    return True, self.step_back(int(cmd[1]) if len(cmd) > 1 else 1)
+                return True, self.run_back_to(int(cmd[1]))
+            except (ValueError, IndexError) as e:
+                print(terminal_fonts.to_warning(e))
+
+    def call(self, label, args=(), returns=1, verbose=0, hooks=None, branches=None, shadow=None, mem_trace=None, step_log=None):
+        # runs the routine at label like BL would and returns X0 or, for returns > 1, [X0, ...]
+        # args go into X0-X7, the other registers are left as they are.
+        # LR points one past the last instruction, so the final BR LR ends the run
+        # without adding anything to the program. every call is its own run,
+        # so the revisit counts start over
+        label = label.strip().upper()
+        hook = self.active_hooks(hooks).get(label)
+        if hook is None:
+            self.enter(label, args)
+            self.run(verbose=verbose, pc=self.pc, hooks=hooks, branches=branches, shadow=shadow, mem_trace=mem_trace, step_log=step_log)
+        else:
+            self.set_arguments(args)
+            self.registers['LR'] = len(self.instrs)
+            self.error = None
+            hook(self)
+            self.halted = True
+        if returns == 1:
+            return self.registers[0]
+        return [self.registers[i] for i in range(returns)]
+
+    def enter(self, label, args=()):
+        # sets up a call of the routine at label without running it,
+        # run_for then runs it in slices until its BR LR returns
+        label = label.strip().upper()
+        if label not in self.labels:
+            raise ValueError(terminal_fonts.to_error('"{}" is not a label of the program'.format(label)))
+        self.set_arguments(args)
+        self.registers['LR'] = len(self.instrs)
+        self._line_visit_tracker = {}
+        if self.journal is not None:
+            self.journal.entries.clear()
+        self.start(self.labels[label])
 
-    def unit_test(self, uut, v=0):
-        procs = ['BL {}'.format(uut.upper().strip()), 'STOP']
-        for proc in procs:
-            self.instrs.append(Instruction(proc))
+    def set_arguments(self, args):
+        if len(args) > 8:
+            raise ValueError(terminal_fonts.to_error('At most 8 arguments can be passed in X0-X7, got {}'.format(len(args))))
+        for i, arg in enumerate(args):
+            self.registers[i] = arg
 
-        self.run(verbose=v, pc=(len(self.instrs) - 2))
+    def unit_test(self, uut, v=0, hooks=None, branches=None, shadow=None):
+        self.call(uut, verbose=v, hooks=hooks, branches=branches, shadow=shadow)
 
     def restore(self):
-        self.__init__(self.text)
-
-    def run(self, verbose=0, bp=[], pc=0):
+        # registered hooks are configuration, not machine state
+        hooks = self.hooks
+        self.__init__(self.program)
+        self.hooks = hooks
+
+    def save_state(self):
+        # a copy of everything a run can change, cheaper to go back to than restore()
+        return (list(self.registers.data), (self.flags.N, self.flags.C, self.flags.Z, self.flags.V),
+                dict(self.memory.data), dict(self.memory.labels), dict(self.memory.label_ends), self.memory.offset,
+                self.console_buffer, dict(self._line_visit_tracker))
+
+    def load_state(self, state):
+        registers, flags, memory, memory_labels, memory_label_ends, memory_offset, console_buffer, visits = state
+        self.registers.data[:] = registers
+        N, C, Z, V = flags
+        self.flags.update(N=N, C=C, Z=Z, V=V)
+        self.memory.data = dict(memory)
+        self.memory.labels = dict(memory_labels)
+        self.memory.label_ends = dict(memory_label_ends)
+        self.memory.offset = memory_offset
+        self.memory.generation += 1
+        self.console_buffer = console_buffer
+        self._line_visit_tracker = dict(visits)
+        if self.journal is not None:
+            self.journal.entries.clear()
+
+    def run(self, verbose=0, bp=[], pc=0, detect_loops=True, mem_trace=None, branches=None, hooks=None, shadow=None, step_log=None,
+            budget=None, resume=False):
         # bp is a list of breakpoints
+        # mem_trace is an optional memtrace.MemoryTraceWriter that records every LDUR/STUR
+        # branches is an optional branch.BranchModel that sees every branch outcome, and
+        # start(pc)/finish(pc) when a run starts or an error ends it before pc
+        # hooks selects the python hooks used for this run, see active_hooks
+        # shadow is an optional shadow.ShadowMemory that checks every LDUR/STUR
+        # step_log is an optional steplog.StepLogWriter, it replaces the -vvv/-vvvv prints
+        # budget stops the run after that many instructions, self.pc is where it stopped
+        # and resume continues a run from there, see run_for
+        hooks = self.active_hooks(hooks)
+        # what the opcode handlers use during this run
+        self.run_hooks = hooks
+        self.mem_trace = mem_trace
+        self.shadow = shadow
+        # the first slice of a resumed run is a new run too
+        new_run = not resume or not self.started
+        self.started = True
+        if shadow is not None and (new_run or shadow.machine is not self):
+            shadow.attach(self)
         # setup the flags
-        program_counter = pc
+        program_counter = self.pc if resume else pc
+        if step_log is not None:
+            step_log.start(self, program_counter, new_run)
+        if branches is not None and new_run:
+            branches.start(program_counter)
+        # fingerprints of the machine state seen at each backward branch target
+        # keyed by pc: (memory generation, set of (registers, flags))
+        if new_run:
+            self.loop_states = {}
+            self.reset_stack_usage()
+            self.error = None
+        loop_states = self.loop_states
+        # locals for what every instruction looks up
+        instrs = self.instrs
+        end = len(instrs)
+        visits = self._line_visit_tracker
+        label_lines = self.program.label_lines
+        registers = self.registers.data
+        max_revisits = self.max_revisits if self.max_revisits is not None else float('inf')
+        self.halted = False
+        executed = 0
+        pause = False
         # run while program_counter hasn't reached the end
         instr_exec_history = 'Instruction Execution History: \n'
-        if verbose:
+        if verbose and new_run:
             print('*** Program Execution Begin ***')
+        instr_pc = program_counter
         try:
-            while program_counter < len(self.instrs):
-                # fetch the instruction
-                instr = self.instrs[program_counter]
+            while program_counter < end:
+                if executed == budget:
+                    break
+                # fetch the instruction, a lazy program decodes it here
+                # before its visit is counted
+                instr_pc = program_counter
+                instr = instrs[program_counter]
 
                 # keeps track and prevent recursion
-                self._line_visit_tracker[program_counter] = self._line_visit_tracker.get(program_counter, 0) + 1
-                if self._line_visit_tracker[program_counter] > MAX_REVISIT_DEPTH:
+                visits[program_counter] = visit = visits.get(program_counter, 0) + 1
+                if visit > max_revisits:
                     raise RecursionError('Reached Max Recursion on instruction: {}'.format(instr))
 
-                if program_counter in self.labels.values():
+                if program_counter in label_lines:
                     program_counter += 1
                     continue
 
-                op = instr.operation
-
-                # all commands that set the flags ends in S
-                set_flags = False
-                if op[-1] == 'S':
-                    set_flags = True
-                    op = op[:-1]
-
-                instr_exec_history += '{:10d}: {}\n'.format(program_counter, instr)
-                if program_counter in bp:
-                    print('{} BREAKPOINT: {} {}'.format(terminal_fonts.BOLD, instr, terminal_fonts.END))
-                    print(self.registers)
-                    print(self.memory)
-                    input("Press any key to continue")
-
-                # run through all the commands
-                if op == 'ADD':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] + self.registers[instr.operand2]
-                elif op == 'ADDI':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] + self.immediate(instr.operand2)
-                elif op == 'AND':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] & self.registers[instr.operand2]
-                elif op == 'ANDI':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] & self.immediate(instr.operand2)
-                elif op == "B":
-                    program_counter = self.labels[instr.operand0]
-                elif op == "BL":
-                    self.registers['LR'] = program_counter + 1
-                    program_counter = self.labels[instr.operand0]
-                elif op == "BR":
-                    program_counter = self.registers[instr.operand0] - 1
-                elif op == "CBNZ":
-                    if self.registers[instr.operand0] != 0:
-                        program_counter = self.labels[instr.operand1]
-                elif op == "CBZ":
-                    if self.registers[instr.operand0] == 0:
-                        program_counter = self.labels[instr.operand1]
-                elif op[0] == 'B':
-                    cond = op.split('.')[1]
-                    cond_pass = False
-
-                    if cond == 'EQ':
-                        cond_pass = bool(self.flags.Z)
-                    elif cond == 'NE':
-                        cond_pass = not bool(self.flags.Z)
-                    elif cond == 'LT':
-                        cond_pass = (bool(self.flags.N) != bool(self.flags.V))
-                    elif cond == 'GT':
-                        cond_pass = (not bool(self.flags.Z) and (bool(self.flags.N) == bool(self.flags.V)))
-                    elif cond == 'GE':
-                        cond_pass = (bool(self.flags.N) == bool(self.flags.V))
-                    elif cond == 'LE':
-                        cond_pass = (bool(self.flags.N) != bool(self.flags.V)) or bool(self.flags.Z)
-                    elif cond == 'MI':
-                        cond_pass = (bool(self.flags.N))
-                    elif cond == 'PL':
-                        cond_pass = not (bool(self.flags.N))
-                    elif cond == 'VS':
-                        cond_pass = bool(self.flags.V)
-                    elif cond == 'VC':
-                        cond_pass = not bool(self.flags.V)
-                    elif cond == 'LO':
-                        cond_pass = not bool(self.flags.C)
-                    elif cond == 'HS':
-                        cond_pass = bool(self.flags.C)
-                    elif cond == 'LS':
-                        cond_pass = not bool(self.flags.C) or bool(self.flags.Z)
-                    elif cond == 'HI':
-                        cond_pass = bool(self.flags.C) and not bool(self.flags.Z)
-                    else:
-                        print('Operation not defined: {}'.format(op))
-                        return self
-                    if cond_pass:
-                        program_counter = self.labels[instr.operand0]
-                elif op == 'EOR':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] ^ self.registers[instr.operand2]
-                elif op == 'EORI':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] ^ self.immediate(instr.operand2)
-                elif op == 'LDUR':
-                    self.registers[instr.operand0] = self.memory[self.address_composer(instr.operand1, instr.operand2)]
-                elif op == 'LDA':
-                    try:
-                        self.registers[instr.operand0] = self.memory.labels[instr.operand1]
-                    except KeyError:
-                        print(terminal_fonts.to_error('"{}" is an invalid memory label.'.format(instr.operand1)))
-                        raise KeyError
-                elif op == 'LSL':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] << self.immediate(instr.operand2)
-                elif op == 'LSR':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] >> self.immediate(instr.operand2)
-                elif op == 'ORR':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] | self.registers[instr.operand2]
-                elif op == 'ORRI':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] | self.immediate(instr.operand2)
-                elif op == 'STUR':
-                    self.memory[self.address_composer(instr.operand1, instr.operand2)] = self.registers[instr.operand0]
-                elif op == 'STOP':
-                    break
-                elif op == 'PUTINT':
-                    self.console_buffer += str(self.registers[instr.operand0])
-                elif op == 'PUTCHAR':
-                    self.console_buffer += chr(self.registers[instr.operand0])
-                elif op == 'SUB':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] - self.registers[instr.operand2]
-                elif op == 'SUBI':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] - self.immediate(instr.operand2)
-                elif op == 'MUL':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] * self.registers[instr.operand2]
-                elif op == 'UDIV':
-                    self.registers[instr.operand0] = self.registers[instr.operand1] // self.registers[instr.operand2]
-                else:
-                    print('Operation not defined: {}'.format(op))
-                    return self
+                opcode = instr.opcode
+                op = opcode.name
+                set_flags = opcode.set_flags
+
+                if verbose >= 2:
+                    instr_exec_history += '{:10d}: {}\n'.format(program_counter, instr)
+                if pause or program_counter in bp:
+                    pause, resume_pc = self.breakpoint_prompt(instr, program_counter)
+                    if resume_pc is not None:
+                        # the seen states are from the undone future
+                        loop_states.clear()
+                        if step_log is not None:
+                            step_log.snapshot(self, resume_pc)
+                        program_counter = resume_pc
+                        continue
+
+                if self.journal is not None:
+                    self.journal.record(self, program_counter, instr)
+
+                # the handler was bound to the instruction when it was decoded
+                next_pc = opcode.handler(self, instr, program_counter)
+                if next_pc is not None:
+                    program_counter = next_pc
+                self.cycles += opcode.cost
+                executed += 1
 
                 # actually set the flags
                 if set_flags:
-                    N = int(self.registers[instr.operand0] < 0)
-                    Z = int(self.registers[instr.operand0] == 0)
-                    C = int(2**64 - 1 < self.registers[instr.operand0])
-                    V = int(2**63 - 1 < self.registers[instr.operand0] < 2**64 - 1)
+                    result = registers[instr.args[0]]
+                    N = int(result < 0)
+                    Z = int(result == 0)
+                    C = int(2**64 - 1 < result)
+                    V = int(2**63 - 1 < result < 2**64 - 1)
                     self.flags.update(N=N, Z=Z, C=C, V=V)
 
-                self.check_overflow()
+                # only the register an instruction writes can overflow
+                if opcode.writes:
+                    result = registers[instr.args[0]]
+                    if not (-2**64 <= result <= 2**64 - 1):
+                        registers[instr.args[0]] = (result + (2**64)) % (2 * (2**64))
 
                 # XZR should always be 0
-                self.registers['XZR'] = 0
+                registers[XZR] = 0
 
                 # verbose level
-                if verbose >= 3:
+                if step_log is not None:
+                    if op == 'BL' and instr.operand0 in hooks:
+                        step_log.snapshot(self, instr_pc)
+                    else:
+                        step_log.record(self, instr_pc, instr)
+                elif verbose >= 3:
                     print(self.registers)
                     if verbose >= 4:
-                        print('Operation: [{}], Operand0: [{}], Operand1: [{}], Operand2: [{}]'.format(op, instr.operand0, instr.operand1, instr.operand2))
+                        print('Operation: [{}], Operand0: [{}], Operand1: [{}], Operand2: [{}]'.format(instr.operation, instr.operand0, instr.operand1, instr.operand2))
                         print(self.memory)
 
+                if branches is not None and opcode.branch:
+                    self.record_branch(branches, op, instr, instr_pc, program_counter)
+
+                # a backward branch that lands on an already seen state loops forever
+                if detect_loops and program_counter < instr_pc:
+                    self.check_loop(loop_states, program_counter, instr_pc)
+
                 program_counter += 1
-        except RecursionError:
+        except InfiniteLoopError as e:
+            # the branch back was taken, its target did not run
+            if branches is not None:
+                branches.finish(program_counter + 1)
+            program_counter = len(self.instrs)
+            self.error = e
+            print(terminal_fonts.to_error(e))
+            print('Looping Block:\n')
+            for instr_num in range(e.loop_start, e.loop_end + 1):
+                print('{:10d}: {} (line {})'.format(instr_num, self.instrs[instr_num], self.source_line(instr_num)))
+        except StackOverflowError as e:
+            self.stop_after(branches, e.pc)
+            program_counter = len(self.instrs)
+            self.error = e
+            print(terminal_fonts.to_error('Stack overflow at line {}: {}'.format(self.source_line(e.pc), e)))
+            print(self.stack_report())
+            print('Call Stack (innermost last):\n')
+            for call_pc in self.call_stack[-STACK_TRACE_DEPTH:]:
+                print('{:10d}: {} (line {})'.format(call_pc, self.instrs[call_pc], self.source_line(call_pc)))
+        except RecursionError as e:
+            # the visit over the limit was counted
+            self.stop_after(branches, instr_pc)
+            program_counter = len(self.instrs)
+            self.error = e
             print('Command Revisit Schedule:\n')
             for instr_num, count in self._line_visit_tracker.items():
                 print('{}: {}'.format(self.instrs[instr_num], count))
+        except SyntaxError as e:
+            # a lazy program found a problem while decoding, the instruction did not run
+            if branches is not None:
+                branches.finish(instr_pc)
+            self.pc = program_counter
+            self.halted = True
+            raise SyntaxError('{} at line {}'.format(e.msg, self.source_line(program_counter))) from None
         except:
+            self.stop_after(branches, instr_pc)
             if not verbose >= 2:
                 sys.tracebacklimit=0
-            raw_line = self.raw_asm_lines[program_counter]
-            raise SyntaxError(terminal_fonts.to_error('Last run command: "{}" at line {}'.format(raw_line, self.find_line_in_original(raw_line)))) from None
-        if verbose:
+            self.pc = program_counter
+            self.halted = True
+            raise SyntaxError(terminal_fonts.to_error('Last run command: "{}" at line {}'.format(self.raw_asm_lines[program_counter], self.source_line(program_counter)))) from None
+        self.pc = program_counter
+        self.halted = program_counter >= len(self.instrs)
+        self.executed = executed
+        if verbose and self.halted:
             print('*** Program Execution Finish ***')
             print(self)
         if verbose >= 2:
             print(instr_exec_history)
         return self
 
+    def run_for(self, budget, **kwargs):
+        # runs at most budget instructions from self.pc and returns how many ran.
+        # the machine keeps its pc between calls, self.halted is set once it
+        # reached STOP or the end, see start/enter to choose where it begins
+        if self.halted:
+            return 0
+        self.run(budget=budget, resume=True, **kwargs)
+        return self.executed
+
+    def step(self, n=1, **kwargs):
+        return self.run_for(n, **kwargs)
+
+    def start(self, pc=0):
+        # the next run_for begins a new run at pc
+        self.pc = pc
+        self.halted = False
+        self.started = False
+
+    def stop_after(self, branches, pc):
+        # the run ended with an error after the visit of pc was counted. a branch
+        # that did not finish recorded nothing, so only the fall through into pc + 1
+        # has to be taken back
+        if branches is not None and not self.instrs[pc].opcode.branch:
+            branches.finish(pc + 1)
+
+    def record_branch(self, branches, op, instr, branch_pc, next_pc):
+        taken = next_pc != branch_pc
+        if op == 'BR':
+            branches.record(branch_pc, next_pc, taken, conditional=False)
+        elif op in ('CBZ', 'CBNZ'):
+            branches.record(branch_pc, self.labels[instr.operand1], taken)
+        else:
+            branches.record(branch_pc, self.labels[instr.operand0], taken, conditional=(op not in ('B', 'BL')))
+
+    def check_loop(self, loop_states, target, branch_pc):
+        # memory is summarized by its write generation, so a state can only
+        # repeat if nothing was stored since the last visit of this target
+        generation = self.memory.generation
+        state = (tuple(self.registers.data), self.flags.N, self.flags.C, self.flags.Z, self.flags.V,
+                 self.input_device.consumed)
+        seen_generation, seen = loop_states.get(target, (None, None))
+        if seen_generation != generation:
+            seen = set()
+            loop_states[target] = (generation, seen)
+        elif state in seen:
+            raise InfiniteLoopError(target, branch_pc)
+        seen.add(state)
+
+    def reset_stack_usage(self):
+        self.stack_top = self.min_sp = self.registers.data[SP]
+        self.call_stack = []
+        self.max_call_depth = 0
+
+    def stack_written(self, pc):
+        # called after every instruction that writes SP
+        sp = self.registers.data[SP]
+        if self.shadow is not None:
+            self.shadow.sp_written(sp)
+        if sp < self.min_sp:
+            self.min_sp = sp
+            if self.stack_limit is not None and self.stack_top - sp > self.stack_limit:
+                raise StackOverflowError('Stack grew to {} bytes, over the limit of {}'.format(self.stack_top - sp, self.stack_limit), pc)
+
+    def stack_usage(self):
+        return {'stack_bytes': self.stack_top - self.min_sp, 'min_sp': self.min_sp, 'max_call_depth': self.max_call_depth}
+
+    def stack_report(self):
+        usage = self.stack_usage()
+        return 'Stack: {} bytes used (lowest SP 0x{:X}), deepest call nesting: {}'.format(
+            usage['stack_bytes'], usage['min_sp'] & 0xFFFFFFFFFFFFFFFF, usage['max_call_depth'])
+
     def check_overflow(self):
         for i in range(32):
             if not (-2**64 <= self.registers[i] <= 2**64 - 1):
                 self.registers[i] = (self.registers[i] + (2**64)) % (2 * (2**64))
 
-    def clean(self, lines):
-        # removes extra lines and comments
-        cleaned = []
-        for line in lines:
-            # only append stuff before comments
-            l = line.strip().split('//')[0].strip()
-            # this is to deal with labels on same line as code
-            if len(l.split(':')) > 1:
-                l1 = l.split(':')[0].strip() + ':'
-                l2 = l.split(':')[1].strip()
-                if l1:
-                    cleaned.append(l1)
-                if l2:
-                    cleaned.append(l2)
-            # only put it into lines if its not blank
-            elif l:
-                cleaned.append(l)
-        return cleaned
+    def effective_address(self, address):
+        # address is a resolved memory operand (base register, offset)
+        base, offset = address
+        return self.registers.data[base] + offset
 
-    def split_sections(self, lines):
-        instr = []
-        data = []
-        for line in lines:
-            if line[0] == '.':
-                data.append(line)
-            else:
-                instr.append(line)
-        return instr, data
-
-    def preprocess(self, lines):
-        processed = []
-        for line in lines:
-            instr = Instruction(line)
-            # handles any equivalent instructions
-            if instr.operation == 'CMP':
-                instr.update('SUBS', 'XZR', instr.operand0, instr.operand1)
-            elif instr.operation == 'CMPI':
-                instr.update('SUBIS', 'XZR', instr.operand0, instr.operand1)
-            elif instr.operation == 'MOV':
-                instr.update('ADD', instr.operand0, 'XZR', instr.operand1)
-            processed.append(str(instr))
-        return processed
-
-    def line_labels(self, lines):
-        label_lines = {}
-        current_line = 0
-        for line in lines:
-            word = line.split(" ")[0]
-            if (word[-1] == ':'):
-                if word[:-1] in label_lines:
-                    raise ValueError(terminal_fonts.to_error("Line label '{}' occurs more than once".format(word[:-1])))
-                label_lines[word[:-1]] = current_line
-            current_line += 1
-        return label_lines
-
-    def immediate(self, operand):
-        if operand[0] == '#':
-            q = int(operand[1:])
-            if q > (2**8):
-                print(terminal_fonts.to_warning('Warning immediate value (#{}) is not able to be processed bare metal'.format(q)))
-            return q
-        else:
-            raise SyntaxError(terminal_fonts.to_error('Unknown immediate value: {}'.format(operand)))
-
-    def address_composer(self, operand1, operand2):
-        if not (operand1[0] == '[' and operand2[-1] == ']'):
-            raise SyntaxError(terminal_fonts.to_error('Unknown address: {}, {}'.format(operand1, operand2)))
-        if not (operand2[0] == '#'):
-            raise SyntaxError(terminal_fonts.to_error('Unknown immediate value: {}'.format(operand2)))
-        return self.registers[operand1[1:]] + int(operand2[1:-1])
-
-    def find_line_in_original(self, match_string):
-        lines = self.text.split('\n')
-        for ln, line in enumerate(lines):
-            if match_string in line: return ln+1 
+    def source_line(self, pc):
+        # line number in the original text
+        return self.program.source_lines[pc]
 
     def __str__(self):
         ret = ''
@@ -330,17 +753,174 @@ class Assembler(object):
         for label in self.labels:
             ret += '\t{}: {}\n'.format(label, self.labels[label])
         ret += '\n\n Instructions: \n'
-        i = 0
-        for instr in self.instrs:
+        if isinstance(self.instrs, LazyInstructions):
+            # only what was decoded, decoding the rest could fail on code that never ran
+            listing = [(i, instr) for i, instr in enumerate(self.instrs.decoded) if instr is not None]
+        else:
+            listing = enumerate(self.instrs)
+        for i, instr in listing:
             ret += '{:10}: {}\n'.format(i, instr)
-            i += 1
         ret += str(self.memory)
         ret += str(self.registers)
+        # printing leaves the output alone, a spec still checks it afterwards
         ret += '\nOutput Buffer:\n{}'.format(self.console_buffer)
-        self.console_buffer = ''
         return ret
 
 
+class UndoJournal(object):
+    def __init__(self, max_entries=UNDO_JOURNAL_SIZE):
+        # one entry per executed instruction, the oldest entries fall off
+        # once max_entries is reached
+        self.entries = collections.deque(maxlen=max_entries)
+
+    def record(self, machine, pc, instr):
+        # saves whatever the instruction is about to overwrite:
+        # (pc, register, old register value, address, old memory bytes, old flags, console length,
+        #  stack usage, input read). stack usage is (call depth, innermost call, deepest call, lowest SP)
+        # for the instructions that update it: BL, BR and writes to SP
+        register = old_value = address = old_bytes = old_flags = stack = None
+        opcode = instr.opcode
+        if opcode.name in ('BL', 'BR') or opcode.writes and instr.args[0] == SP:
+            calls = machine.call_stack
+            stack = (len(calls), calls[-1] if calls else None, machine.max_call_depth, machine.min_sp)
+        if opcode.writes:
+            register = instr.args[0]
+        elif opcode.name == 'BL':
+            register = LR
+        elif opcode.name in ('STUR', 'STURB'):
+            address = machine.effective_address(instr.args[1])
+            old_bytes = tuple(machine.memory.data.get(address + i) for i in range(8))
+        if register is not None:
+            old_value = machine.registers[register]
+        if opcode.changes_flags:
+            f = machine.flags
+            old_flags = (f.N, f.C, f.Z, f.V)
+        self.entries.append((pc, register, old_value, address, old_bytes, old_flags, len(machine.console_buffer), stack, None))
+
+    def record_input(self, text):
+        # input instructions only know what they consumed after running
+        self.entries[-1] = self.entries[-1][:-1] + (text,)
+
+    def undo(self, machine):
+        # restores the state from before the newest entry and returns its pc
+        pc, register, old_value, address, old_bytes, old_flags, console_length, stack, input_read = self.entries.pop()
+        if register is not None:
+            machine.registers[register] = old_value
+        if address is not None:
+            for i, b in enumerate(old_bytes):
+                if b is None:
+                    machine.memory.data.pop(address + i, None)
+                else:
+                    machine.memory.data[address + i] = b
+            machine.memory.generation += 1
+        if old_flags is not None:
+            N, C, Z, V = old_flags
+            machine.flags.update(N=N, C=C, Z=Z, V=V)
+        machine.console_buffer = machine.console_buffer[:console_length]
+        if stack is not None:
+            depth, innermost, machine.max_call_depth, machine.min_sp = stack
+            # a BL pushed one call, a BR popped one
+            del machine.call_stack[depth:]
+            if len(machine.call_stack) < depth:
+                machine.call_stack.append(innermost)
+        if input_read is not None:
+            machine.input_device.unread(input_read)
+        machine._line_visit_tracker[pc] -= 1
+        return pc
+
+    def contains(self, pc):
+        return any(entry[0] == pc for entry in self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class InputDevice(object):
+    def __init__(self, source='', chunk_size=65536):
+        # input is read from the source in chunks as the program asks for it,
+        # so only one chunk of a large input is held at a time
+        if isinstance(source, str):
+            source = io.StringIO(source)
+        self.stream = source
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        # number of values read so far and the raw text of the last one
+        self.consumed = 0
+        self.last_read = None
+
+    def fill(self):
+        # binary streams go through an incremental decoder, so a character
+        # split between two chunks is only decoded once both are read
+        chunk = ''
+        while not chunk:
+            data = self.stream.read(self.chunk_size)
+            if isinstance(data, bytes):
+                chunk = self.decoder.decode(data, final=not data)
+            else:
+                chunk = data
+            if not data:
+                break
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def getchar(self):
+        # returns -1 at the end of the input like C's getchar
+        if self.pos >= len(self.buffer) and not self.fill():
+            self.last_read = ''
+            return -1
+        c = self.buffer[self.pos]
+        self.pos += 1
+        self.consumed += 1
+        self.last_read = c
+        return ord(c)
+
+    def getint(self):
+        # reads the next whitespace separated integer, None at the end of the input
+        start = self.pos
+        skipped = ''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                break
+            skipped += self.buffer[start:self.pos]
+            if not self.fill():
+                # nothing is consumed, the whitespace is still there for GETCHAR
+                self.buffer, self.pos = skipped, 0
+                self.last_read = ''
+                return None
+            start = self.pos
+        skipped += self.buffer[start:self.pos]
+        token = ''
+        while True:
+            end = self.pos
+            while end < len(self.buffer) and not self.buffer[end].isspace():
+                end += 1
+            token += self.buffer[self.pos:end]
+            self.pos = end
+            if end < len(self.buffer) or not self.fill():
+                break
+        try:
+            value = int(token)
+        except ValueError:
+            raise ValueError(terminal_fonts.to_error('Invalid integer input: {}'.format(token))) from None
+        self.consumed += 1
+        self.last_read = skipped + token
+        return value
+
+    def unread(self, text):
+        # puts back text returned by a read, used when stepping back
+        self.buffer = text + self.buffer[self.pos:]
+        self.pos = 0
+        if text:
+            self.consumed -= 1
+
+
 class terminal_fonts:
     WARNING = '\033[93m'
     FAIL = '\033[91m'
@@ -359,41 +939,450 @@ class terminal_fonts:
 
 
 class Instruction(object):
+    # operands resolved by Program.resolve, one per letter of the opcode's operand format
+    args = ()
+
     def __init__(self, line, strict=True):
         self.raw = line
         line = line.upper()
+        # whatever the parser did not understand, reported by Program.validate
+        self.extra = ''
 
         if strict:
             q = re.match(r"((?:B\S)?\w+:?)(?:\s+(\w+))?(?:\s+)?(?:,(?:\s+)?((?:\[(?:\s+)?)?\w+))?(?:\s+)?(?:,(?:\s+)?(\#?-?\w+(?:\])?))?", line)
-            self.operation = q.groups()[0]
-            self.operand0 = q.groups()[1]
-            self.operand1 = q.groups()[2]
-            self.operand2 = q.groups()[3]
+            if q is None:
+                self.operation, self.operand0, self.operand1, self.operand2 = line, None, None, None
+            else:
+                self.operation, self.operand0, self.operand1, self.operand2 = q.groups()
+                self.extra = line[q.end():].strip()
+                # an immediate right after operand0 (e.g. CMPI X1, #5) is matched as operand2
+                if self.operand1 is None and self.operand2 is not None:
+                    self.operand1, self.operand2 = self.operand2, None
         else:
             words = line.upper().replace(",", " ").split()
             self.operation = words[0]
             self.operand0 = words[1] if len(words) > 1 else None
             self.operand1 = words[2] if len(words) > 2 else None
             self.operand2 = words[3] if len(words) > 3 else None
+        self.opcode = OPCODES.get(self.operation, UNDEFINED)
+
+    @classmethod
+    def from_fields(cls, raw, operation, operand0=None, operand1=None, operand2=None, extra=''):
+        # skips parsing for instructions that were already decoded once
+        instr = cls.__new__(cls)
+        instr.raw = raw
+        instr.extra = extra
+        instr.update(operation, operand0, operand1, operand2)
+        return instr
 
     def __str__(self):
-        return "{} {}".format(self.operation, ", ".join([v for v in [self.operand0, self.operand1, self.operand2] if v is not None]))
+        return "{} {}".format(self.operation, ", ".join(self.operands()))
+
+    def operands(self):
+        return [v for v in [self.operand0, self.operand1, self.operand2] if v is not None]
+
+    def set_args(self, args):
+        # the resolved operands, see Program.resolve
+        self.args = tuple(args)
+        if self.opcode.writes and self.args and self.args[0] == SP:
+            # only instructions that write SP pay for the stack high water mark
+            self.opcode = self.opcode.writing_sp()
 
     def update(self, operation, operand0, operand1, operand2):
         self.operation = operation
         self.operand0 = operand0
         self.operand1 = operand1
         self.operand2 = operand2
-        pass
+        # the handler is looked up once here instead of on every execution
+        self.opcode = OPCODES.get(operation, UNDEFINED)
+
+
+class Opcode(object):
+    # what the assembler knows about an operation, bound to every Instruction
+    # when it is decoded so run does not have to look anything up
+    def __init__(self, name, handler, operands='', writes=False, branch=False, cost=1, set_flags=False, handler_flags=False):
+        # name is shared by an operation and its flag setting (S) variant.
+        # set_flags operations get their flags from operand0 after the handler runs,
+        # handler_flags operations have a handler that updates the flags itself
+        self.name = name
+        self.handler = handler
+        self.operands = operands
+        self.writes = writes
+        self.branch = branch
+        self.cost = cost
+        self.set_flags = set_flags
+        self.handler_flags = handler_flags
+        # what the undo journal and step logs save the flags for
+        self.changes_flags = set_flags or handler_flags
+        self.sp_variant = None
+
+    def writing_sp(self):
+        # the same operation, followed by a stack check for instructions that write SP
+        if self.sp_variant is None:
+            handler = self.handler
+
+            def op_write_sp(m, instr, pc):
+                next_pc = handler(m, instr, pc)
+                m.stack_written(pc)
+                return next_pc
+            self.sp_variant = Opcode(self.name, op_write_sp, self.operands, self.writes, self.branch, self.cost, self.set_flags,
+                                     self.handler_flags)
+            self.sp_variant.sp_variant = self.sp_variant
+        return self.sp_variant
+
+
+OPCODES = {}
+PSEUDO_OPS = {}
+
+
+def opcode(name, operands='', flags=False, writes=False, branch=False, cost=1, handler_flags=False):
+    # registers handler(machine, instr, pc) as the semantics of an operation.
+    # the handler returns the pc of a taken branch (execution continues after it) or None.
+    # operands is the operand format, one letter per operand:
+    #   R register, I immediate (#n), M memory ([Xn, #n]), L code label, D data label
+    # writes is set for operations that overwrite the register in operand0,
+    # with flags, name + 'S' also exists and sets the flags from operand0.
+    # handler_flags is set for operations whose handler updates the flags itself.
+    # cost is an estimate of the cycles it takes, summed in Assembler.cycles
+    def register(handler):
+        OPCODES[name] = Opcode(name, handler, operands, writes, branch, cost, handler_flags=handler_flags)
+        if flags:
+            OPCODES[name + 'S'] = Opcode(name, handler, operands, writes, branch, cost, set_flags=True)
+        return handler
+    return register
+
+
+def pseudo_op(name):
+    # registers expand(instr) -> (operation, operand0, operand1, operand2) for an
+    # operation that is replaced by another one when the program is assembled
+    def register(expand):
+        PSEUDO_OPS[name] = expand
+        return expand
+    return register
+
+
+def undefined_operation(machine, instr, pc):
+    print('Operation not defined: {}'.format(instr.operation))
+    return len(machine.instrs)
+
+
+UNDEFINED = Opcode(None, undefined_operation)
+
+
+def to_signed(value):
+    value &= 0xFFFFFFFFFFFFFFFF
+    return value - (1 << 64) if value & (1 << 63) else value
+
+
+@pseudo_op('CMP')
+def expand_cmp(instr):
+    return 'SUBS', 'XZR', instr.operand0, instr.operand1
+
+
+@pseudo_op('CMPI')
+def expand_cmpi(instr):
+    return 'SUBIS', 'XZR', instr.operand0, instr.operand1
+
+
+@pseudo_op('MOV')
+def expand_mov(instr):
+    return 'ADD', instr.operand0, 'XZR', instr.operand1
+
+
+@opcode('ADD', 'RRR', flags=True, writes=True)
+def op_add(m, instr, pc):
+    d, n, k = instr.args
+    r = m.registers.data
+    r[d] = r[n] + r[k]
+
+
+@opcode('ADDI', 'RRI', flags=True, writes=True)
+def op_addi(m, instr, pc):
+    d, n, imm = instr.args
+    r = m.registers.data
+    r[d] = r[n] + imm
+
+
+@opcode('AND', 'RRR', flags=True, writes=True)
+def op_and(m, instr, pc):
+    d, n, k = instr.args
+    r = m.registers.data
+    r[d] = r[n] & r[k]
+
+
+@opcode('ANDI', 'RRI', flags=True, writes=True)
+def op_andi(m, instr, pc):
+    d, n, imm = instr.args
+    r = m.registers.data
+    r[d] = r[n] & imm
+
+
+@opcode('EOR', 'RRR', flags=True, writes=True)
+def op_eor(m, instr, pc):
+    d, n, k = instr.args
+    r = m.registers.data
+    r[d] = r[n] ^ r[k]
+
+
+@opcode('EORI', 'RRI', flags=True, writes=True)
+def op_eori(m, instr, pc):
+    d, n, imm = instr.args
+    r = m.registers.data
+    r[d] = r[n] ^ imm
+
+
+@opcode('ORR', 'RRR', flags=True, writes=True)
+def op_orr(m, instr, pc):
+    d, n, k = instr.args
+    r = m.registers.data
+    r[d] = r[n] | r[k]
+
+
+@opcode('ORRI', 'RRI', flags=True, writes=True)
+def op_orri(m, instr, pc):
+    d, n, imm = instr.args
+    r = m.registers.data
+    r[d] = r[n] | imm
+
+
+@opcode('SUB', 'RRR', flags=True, writes=True)
+def op_sub(m, instr, pc):
+    d, n, k = instr.args
+    r = m.registers.data
+    r[d] = r[n] - r[k]
+
+
+@opcode('SUBI', 'RRI', flags=True, writes=True)
+def op_subi(m, instr, pc):
+    d, n, imm = instr.args
+    r = m.registers.data
+    r[d] = r[n] - imm
+
+
+@opcode('MUL', 'RRR', writes=True, cost=4)
+def op_mul(m, instr, pc):
+    d, n, k = instr.args
+    r = m.registers.data
+    r[d] = r[n] * r[k]
+
+
+@opcode('UDIV', 'RRR', writes=True, cost=12)
+def op_udiv(m, instr, pc):
+    d, n, k = instr.args
+    r = m.registers.data
+    r[d] = r[n] // r[k]
+
+
+@opcode('SDIV', 'RRR', writes=True, cost=12)
+def op_sdiv(m, instr, pc):
+    # rounds towards zero like the hardware, not down like python
+    d, n, k = instr.args
+    r = m.registers.data
+    a, b = to_signed(r[n]), to_signed(r[k])
+    q = abs(a) // abs(b)
+    r[d] = q if (a < 0) == (b < 0) else -q
+
+
+@opcode('LSL', 'RRI', writes=True)
+def op_lsl(m, instr, pc):
+    d, n, imm = instr.args
+    r = m.registers.data
+    r[d] = r[n] << imm
+
+
+@opcode('LSR', 'RRI', writes=True)
+def op_lsr(m, instr, pc):
+    d, n, imm = instr.args
+    r = m.registers.data
+    r[d] = r[n] >> imm
+
+
+@opcode('ASR', 'RRI', writes=True)
+def op_asr(m, instr, pc):
+    d, n, imm = instr.args
+    r = m.registers.data
+    r[d] = to_signed(r[n]) >> imm
+
+
+@opcode('B', 'L', branch=True)
+def op_b(m, instr, pc):
+    return instr.args[0]
+
+
+@opcode('BL', 'L', branch=True)
+def op_bl(m, instr, pc):
+    m.registers.data[LR] = pc + 1
+    hook = m.run_hooks.get(instr.operand0)
+    if hook is None:
+        m.call_stack.append(pc)
+        if len(m.call_stack) > m.max_call_depth:
+            m.max_call_depth = len(m.call_stack)
+            if m.call_depth_limit is not None and m.max_call_depth > m.call_depth_limit:
+                raise StackOverflowError('Call depth {} is over the limit of {}'.format(m.max_call_depth, m.call_depth_limit), pc)
+        return instr.args[0]
+    hook(m)
+    # the hook could have changed any register
+    m.check_overflow()
+    m.stack_written(pc)
+    # whatever the hook changed can not be undone, and it can depend on
+    # state the loop fingerprints do not cover, so the same state can repeat
+    if m.journal is not None:
+        m.journal.entries.clear()
+    m.loop_states.clear()
+    return m.registers.data[LR] - 1
+
+
+@opcode('BR', 'R', branch=True)
+def op_br(m, instr, pc):
+    if m.call_stack:
+        m.call_stack.pop()
+    return m.registers.data[instr.args[0]] - 1
+
+
+@opcode('CBNZ', 'RL', branch=True)
+def op_cbnz(m, instr, pc):
+    if m.registers.data[instr.args[0]] != 0:
+        return instr.args[1]
+
+
+@opcode('CBZ', 'RL', branch=True)
+def op_cbz(m, instr, pc):
+    if m.registers.data[instr.args[0]] == 0:
+        return instr.args[1]
+
+
+CONDITIONS = {
+    'EQ': lambda f: bool(f.Z),
+    'NE': lambda f: not bool(f.Z),
+    'LT': lambda f: bool(f.N) != bool(f.V),
+    'GT': lambda f: not bool(f.Z) and bool(f.N) == bool(f.V),
+    'GE': lambda f: bool(f.N) == bool(f.V),
+    'LE': lambda f: bool(f.N) != bool(f.V) or bool(f.Z),
+    'MI': lambda f: bool(f.N),
+    'PL': lambda f: not bool(f.N),
+    'VS': lambda f: bool(f.V),
+    'VC': lambda f: not bool(f.V),
+    'LO': lambda f: not bool(f.C),
+    'HS': lambda f: bool(f.C),
+    'LS': lambda f: not bool(f.C) or bool(f.Z),
+    'HI': lambda f: bool(f.C) and not bool(f.Z),
+}
+
+
+def conditional_branch(cond_pass):
+    def op_b_cond(m, instr, pc):
+        if cond_pass(m.flags):
+            return instr.args[0]
+    return op_b_cond
+
+
+for cond, cond_pass in CONDITIONS.items():
+    opcode('B.' + cond, 'L', branch=True)(conditional_branch(cond_pass))
+
+
+@opcode('LDUR', 'RM', writes=True, cost=2)
+def op_ldur(m, instr, pc):
+    d, (base, offset) = instr.args
+    address = m.registers.data[base] + offset
+    if m.shadow is not None:
+        m.shadow.check_read(pc, address, base=address - offset)
+    value = m.memory[address]
+    m.registers.data[d] = value
+    if m.mem_trace is not None:
+        m.mem_trace.record_read(pc, address, value)
+
+
+@opcode('STUR', 'RM', cost=2)
+def op_stur(m, instr, pc):
+    t, (base, offset) = instr.args
+    address = m.registers.data[base] + offset
+    value = m.registers.data[t]
+    if m.shadow is not None:
+        m.shadow.check_write(pc, address, base=address - offset)
+    m.memory[address] = value
+    if m.mem_trace is not None:
+        m.mem_trace.record_write(pc, address, value)
+
+
+@opcode('LDURB', 'RM', writes=True, cost=2)
+def op_ldurb(m, instr, pc):
+    d, (base, offset) = instr.args
+    address = m.registers.data[base] + offset
+    if m.shadow is not None:
+        m.shadow.check_read(pc, address, 1, base=address - offset)
+    value = m.memory.load_byte(address)
+    m.registers.data[d] = value
+    if m.mem_trace is not None:
+        m.mem_trace.record_read(pc, address, value)
+
+
+@opcode('STURB', 'RM', cost=2)
+def op_sturb(m, instr, pc):
+    t, (base, offset) = instr.args
+    address = m.registers.data[base] + offset
+    value = m.registers.data[t] & 0xFF
+    if m.shadow is not None:
+        m.shadow.check_write(pc, address, 1, base=address - offset)
+    m.memory.store_byte(address, value)
+    if m.mem_trace is not None:
+        m.mem_trace.record_write(pc, address, value)
+
+
+@opcode('LDA', 'RD', writes=True)
+def op_lda(m, instr, pc):
+    # data labels can still be added after assembly (e.g. by test specs)
+    d, label = instr.args
+    try:
+        m.registers.data[d] = m.memory.labels[label]
+    except KeyError:
+        print(terminal_fonts.to_error('"{}" is an invalid memory label.'.format(label)))
+        raise KeyError
+
+
+@opcode('STOP')
+def op_stop(m, instr, pc):
+    return len(m.instrs)
+
+
+@opcode('PUTINT', 'R')
+def op_putint(m, instr, pc):
+    m.console_buffer += str(m.registers.data[instr.args[0]])
+
+
+@opcode('PUTCHAR', 'R')
+def op_putchar(m, instr, pc):
+    m.console_buffer += chr(m.registers.data[instr.args[0]])
+
+
+@opcode('GETINT', 'R', writes=True, handler_flags=True)
+def op_getint(m, instr, pc):
+    # at the end of the input Xd is 0 and Z is set, so a program can stop
+    # reading with B.EQ. every integer read clears Z
+    value = m.input_device.getint()
+    m.flags.update(Z=int(value is None))
+    m.registers.data[instr.args[0]] = value or 0
+    if m.journal is not None:
+        m.journal.record_input(m.input_device.last_read)
+
+
+@opcode('GETCHAR', 'R', writes=True)
+def op_getchar(m, instr, pc):
+    m.registers.data[instr.args[0]] = m.input_device.getchar()
+    if m.journal is not None:
+        m.journal.record_input(m.input_device.last_read)
 
 
 class Memory(object):
     def __init__(self, offset=0x1000, print_type='DEC'):
         self.data = {}
         self.labels = {}
+        # one past the last byte of every label, labels are [start, end) ranges
+        self.label_ends = {}
         self.print_type = print_type
         self.offset = offset
         self.default_offset = offset
+        # bumped on every store, used to cheaply tell if memory has changed
+        self.generation = 0
 
     def __str__(self):
         str_return = '\nMemories: (HEX: {})\n'.format(self.print_type)
@@ -411,6 +1400,7 @@ class Memory(object):
         # so split it into 8 bytes, and store each byte into the key
         # we don't have to do this, but it will help catch code that
         # slips in memory
+        self.generation += 1
         self.data[key] = value & 0xFF
         self.data[key + 1] = (value >> 8) & 0xFF
         self.data[key + 2] = (value >> 16) & 0xFF
@@ -441,6 +1431,17 @@ class Memory(object):
             pass
         return return_val if not (return_val & (1 << 63)) else (return_val - (1 << 64))
 
+    def load_byte(self, key):
+        return self.data.get(key, 0)
+
+    def store_byte(self, key, value):
+        self.generation += 1
+        self.data[key] = value & 0xFF
+
+    def read(self, address, length):
+        # the bytes of a range as one bytes object, unwritten bytes are 0
+        return bytes(map(self.data.get, range(address, address + length), itertools.repeat(0)))
+
     def insert(self, line):
         # this is to take the data lines and store it with a specific label
         # the format is .dtype NAME CSV
@@ -448,10 +1449,15 @@ class Memory(object):
         dtype, name, values = dtype[1:].lower(), name.upper(), [v.strip() for v in values.split(",")]
         if dtype not in ['long']:
             raise ValueError(terminal_fonts.to_error('Invalid data type: {}'.format(dtype)))
-        self.labels[name] = self.offset
+        self.insert_values(name, [int(value) for value in values])
+
+    def insert_values(self, name, values):
+        # .long data from python values, without going through the text form
+        self.labels[name.upper()] = self.offset
         for value in values:
-            self[self.offset] = int(value)
+            self[self.offset] = value
             self.offset += 8
+        self.label_ends[name.upper()] = self.offset
 
     def reset(self):
         self.__init__()
@@ -479,27 +1485,28 @@ class Flags(object):
 
 
 class Registers(object):
+    # we can refer to the same register using multiple names
+    # so we make a dict that points to each register
+    conversion_dict = {'X0': 0, 'X1': 1,
+                       'X2': 2, 'X3': 3,
+                       'X4': 4, 'X5': 5,
+                       'X6': 6, 'X7': 7,
+                       'X8': 8, 'X9': 9,
+                       'X10': 10, 'X11': 11,
+                       'X12': 12, 'X13': 13,
+                       'X14': 14, 'X15': 15,
+                       'X16': 16, 'X17': 17,
+                       'X18': 18, 'X19': 19,
+                       'X20': 20, 'X21': 21,
+                       'X22': 22, 'X23': 23,
+                       'X24': 24, 'X25': 25,
+                       'X26': 26, 'X27': 27,
+                       'X28': 28, 'X29': 29,
+                       'X30': 30, 'X31': 31,
+                       'XZR': 31, 'LR': 30,
+                       'FP': 29, 'SP': 28}
+
     def __init__(self, SP_val=0x007FFFFFFFFC, FP_val=0x007FFFFFFFFC, print_type='DEC'):
-        # we can refer to the same register using multiple names
-        # so we make a dict that points to each register
-        self.conversion_dict = {'X0': 0, 'X1': 1,
-                                'X2': 2, 'X3': 3,
-                                'X4': 4, 'X5': 5,
-                                'X6': 6, 'X7': 7,
-                                'X8': 8, 'X9': 9,
-                                'X10': 10, 'X11': 11,
-                                'X12': 12, 'X13': 13,
-                                'X14': 14, 'X15': 15,
-                                'X16': 16, 'X17': 17,
-                                'X18': 18, 'X19': 19,
-                                'X20': 20, 'X21': 21,
-                                'X22': 22, 'X23': 23,
-                                'X24': 24, 'X25': 25,
-                                'X26': 26, 'X27': 27,
-                                'X28': 28, 'X29': 29,
-                                'X30': 30, 'X31': 31,
-                                'XZR': 31, 'LR': 30,
-                                'FP': 29, 'SP': 28}
         self.data = [0] * (max(self.conversion_dict.values()) + 1)
         self['SP'] = SP_val
         self['FP'] = FP_val
@@ -562,21 +1569,83 @@ class Registers(object):
         self.__init__()
 
 
+LR = Registers.conversion_dict['LR']
+SP = Registers.conversion_dict['SP']
+XZR = Registers.conversion_dict['XZR']
+
+
 def main(argv):
     parser = argparse.ArgumentParser()
-    parser.add_argument("input_file", help="name of the LEGv8 program file")
+    parser.add_argument("input_file", help="name of the LEGv8 program file, several files are linked in order", nargs='+')
+    parser.add_argument("--obj-cache", help="directory to keep assembled files in when linking")
     parser.add_argument("-v", "--verbose", help="prints status of registers and memory", action='count', default=0)
     parser.add_argument("-o", "--output", help="saves output to file instead of console")
-    parser.add_argument("-bp", help="adds a breakpoint at the line specified", action='append')
+    parser.add_argument("-i", "--input", help="file read by GETINT/GETCHAR ('-' for stdin)")
+    parser.add_argument("-bp", help="adds a breakpoint at the line specified", action='append', type=int)
+    parser.add_argument("--journal", help="number of instructions that can be stepped back at a breakpoint", type=int, default=UNDO_JOURNAL_SIZE)
+    parser.add_argument("--mem-trace", help="records every memory access to a binary trace file")
+    parser.add_argument("--step-log", help="logs what every instruction changed to a file, read it with steplog.py")
+    parser.add_argument("--check-memory", help="reports uninitialized, out of range and unaligned memory accesses", action='store_true')
+    parser.add_argument("--branch-stats", help="simulates branch predictors and prints branch statistics", action='store_true')
+    parser.add_argument("--stack-stats", help="prints how much stack and call nesting the program used", action='store_true')
+    parser.add_argument("--stack-limit", help="stops with a stack overflow when the stack grows past this many bytes", type=int)
+    parser.add_argument("--call-depth-limit", help="stops with a stack overflow when BLs nest deeper than this", type=int)
+    parser.add_argument("--max-revisits", help="stops when one instruction runs more than this many times (0 for no limit)", type=int, default=MAX_REVISIT_DEPTH)
     args = parser.parse_args(argv)
-    p = open(args.input_file, 'r')
-    a = Assembler(p)
+    try:
+        if len(args.input_file) > 1 or args.obj_cache:
+            from linker import build
+            a = Assembler(build(args.input_file, args.obj_cache))
+        else:
+            a = Assembler(open(args.input_file[0], 'r'))
+    except (SyntaxError, ValueError) as e:
+        # every problem found while assembling or linking, no need for a traceback
+        sys.exit(str(e))
+    if args.input == '-':
+        a.set_input(sys.stdin)
+    elif args.input:
+        a.set_input(open(args.input, 'r'))
+    a.stack_limit = args.stack_limit
+    a.call_depth_limit = args.call_depth_limit
+    a.max_revisits = args.max_revisits or None
     if args.bp is None:
         args.bp = []
+    else:
+        a.enable_journal(args.journal)
     if args.output:
         sys.stdout = open(args.output, 'w')
-    a.run(verbose=args.verbose, bp=args.bp)
-    print(a)
+    mem_trace = None
+    if args.mem_trace:
+        from memtrace import MemoryTraceWriter
+        mem_trace = MemoryTraceWriter(args.mem_trace)
+    branches = None
+    if args.branch_stats:
+        from branch import BranchModel
+        branches = BranchModel()
+    shadow = None
+    if args.check_memory:
+        from shadow import ShadowMemory
+        shadow = ShadowMemory()
+    step_log = None
+    if args.step_log:
+        from steplog import StepLogWriter
+        step_log = StepLogWriter(args.step_log)
+    try:
+        a.run(verbose=args.verbose, bp=args.bp, mem_trace=mem_trace, branches=branches, shadow=shadow, step_log=step_log)
+    finally:
+        if mem_trace is not None:
+            mem_trace.close()
+        if step_log is not None:
+            step_log.close()
+    # a verbose run already printed the machine when it finished
+    if not (args.verbose and a.halted):
+        print(a)
+    if branches is not None:
+        print(branches.report(a.instrs))
+    if args.stack_stats:
+        print(a.stack_report())
+    if shadow is not None:
+        print(shadow.report())
 
 
 if __name__ == '__main__':
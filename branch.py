@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+PREDICTORS = ('static', '1-bit', '2-bit', 'gshare')
+
+
+class BranchModel(object):
+    def __init__(self, table_bits=10, history_bits=8, btb_entries=64):
+        # per branch pc: [taken, not taken, static, 1-bit, 2-bit, gshare mispredictions, btb misses,
+        #                 conditional executions]
+        self.branches = {}
+        self.table_mask = (1 << table_bits) - 1
+        self.history_mask = (1 << history_bits) - 1
+        # 1-bit predictors remember the last outcome, 2-bit predictors are
+        # saturating counters starting at weakly not taken
+        self.one_bit = [0] * (1 << table_bits)
+        self.two_bit = [1] * (1 << table_bits)
+        self.gshare = [1] * (1 << table_bits)
+        self.history = 0
+        # direct mapped branch target buffer of (branch pc, target)
+        self.btb_entries = btb_entries
+        self.btb = [None] * btb_entries
+
+    def start(self, pc):
+        pass
+
+    def finish(self, pc):
+        pass
+
+    def record(self, pc, target, taken, conditional=True):
+        stats = self.branches.get(pc)
+        if stats is None:
+            stats = self.branches[pc] = [0] * 8
+        stats[0 if taken else 1] += 1
+
+        if conditional:
+            stats[7] += 1
+            i = pc & self.table_mask
+            g = (pc ^ self.history) & self.table_mask
+            # static prediction: backward taken, forward not taken
+            stats[2] += (target < pc) != taken
+            stats[3] += self.one_bit[i] != taken
+            stats[4] += (self.two_bit[i] >= 2) != taken
+            stats[5] += (self.gshare[g] >= 2) != taken
+            self.one_bit[i] = int(taken)
+            if taken:
+                self.two_bit[i] = min(self.two_bit[i] + 1, 3)
+                self.gshare[g] = min(self.gshare[g] + 1, 3)
+            else:
+                self.two_bit[i] = max(self.two_bit[i] - 1, 0)
+                self.gshare[g] = max(self.gshare[g] - 1, 0)
+            self.history = ((self.history << 1) | int(taken)) & self.history_mask
+
+        # taken branches also need the right target from the btb
+        if taken:
+            slot = pc % self.btb_entries
+            if self.btb[slot] != (pc, target):
+                stats[6] += 1
+                self.btb[slot] = (pc, target)
+
+    def totals(self):
+        # [executed, taken, static, 1-bit, 2-bit, gshare mispredictions, btb misses, conditional executed]
+        total = [0] * 8
+        for stats in self.branches.values():
+            total[0] += stats[0] + stats[1]
+            total[1] += stats[0]
+            for i in range(2, 8):
+                total[i] += stats[i]
+        return total
+
+    def report(self, instrs=None):
+        ret = 'Branch Statistics:\n'
+        ret += '{:>10}  {:>10} {:>10} {:>8} {:>8} {:>8} {:>8} {:>8}  {}\n'.format(
+            'pc', 'taken', 'not taken', *PREDICTORS, 'btb miss', 'instruction')
+        for pc in sorted(self.branches):
+            stats = self.branches[pc]
+            ret += '{:10d}: {:10d} {:10d} {:8d} {:8d} {:8d} {:8d} {:8d}  {}\n'.format(
+                pc, *stats[:7], instrs[pc] if instrs is not None else '')
+        total = self.totals()
+        ret += 'Branches executed: {}, taken: {}, conditional: {}\n'.format(total[0], total[1], total[7])
+        # only conditional branches are predicted
+        for name, missed in zip(PREDICTORS, total[2:6]):
+            ret += '{:>8} mispredictions: {} ({:.2%})\n'.format(name, missed, missed / total[7] if total[7] else 0)
+        ret += 'BTB misses: {}\n'.format(total[6])
+        return ret
+
+    def __str__(self):
+        return self.report()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from assembler import Assembler 
+from fuzz import Fuzzer
 import random
 
 def test_func1(a):
@@ -48,6 +49,21 @@ def test_func2(a):
     print('All tests passed for {}'.format(uut))
     return result
 
+def fuzz_func2():
+    uut = 'func2'
+    print('Commencing fuzzing on function: {}'.format(uut))
+    # the python reference for what func2 should return
+    def oracle(inputs):
+        b = inputs['registers']['X0']
+        c = inputs['registers']['X1']
+        return {'registers': {'X2': (b if b > c else c) + 5}}
+    fuzzer = Fuzzer(open('demo.s', 'r'), uut, oracle, [{'registers': {'X0': 0, 'X1': 0}}], value_range=(0, 2**11))
+    failures = fuzzer.run(executions=2000)
+    print('{} executions, {} branch edges covered'.format(fuzzer.executions, fuzzer.coverage.edges))
+    # failures are (smallest failing input, what went wrong)
+    assert(not failures)
+    print('No failures found for {}'.format(uut))
+
 def main():
     p = open('demo.s', 'r')
     a = Assembler(p)
@@ -56,6 +72,8 @@ def main():
     print('')
     test_func2(a)
     print('')
+    fuzz_func2()
+    print('')
 
 
 if __name__ == '__main__':
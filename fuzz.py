@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import random
+import time
+
+from spec_runner import SpecRunner
+
+COVERAGE_MAP_SIZE = 1 << 16
+
+
+def copy_inputs(inputs):
+    # a copy that can be mutated without touching inputs, much cheaper than a
+    # deepcopy since only the registers, memory and its arrays are containers
+    child = dict(inputs)
+    child['registers'] = dict(inputs.get('registers', {}))
+    child['memory'] = {label: list(values) if isinstance(values, list) else values
+                       for label, values in inputs.get('memory', {}).items()}
+    return child
+
+
+class EdgeCoverage(object):
+    def __init__(self, limit, size=COVERAGE_MAP_SIZE):
+        # same interface as branch.BranchModel, every branch edge of a run
+        # sets one byte of the map and the touched bytes are cleared afterwards.
+        # targets past limit (the return address of Assembler.call) all count as one
+        self.limit = limit
+        self.mask = size - 1
+        self.trace = bytearray(size)
+        self.touched = []
+        self.seen = bytearray(size)
+        self.edges = 0
+
+    def start(self, pc):
+        pass
+
+    def finish(self, pc):
+        pass
+
+    def record(self, pc, target, taken, conditional=True):
+        i = ((pc << 1) ^ (min(target, self.limit) << 5) ^ taken) & self.mask
+        if not self.trace[i]:
+            self.trace[i] = 1
+            self.touched.append(i)
+
+    def commit(self):
+        # merges the last run into the total coverage, returns if it found new edges
+        new = False
+        for i in self.touched:
+            self.trace[i] = 0
+            if not self.seen[i]:
+                self.seen[i] = 1
+                self.edges += 1
+                new = True
+        self.touched = []
+        return new
+
+
+class Fuzzer(object):
+    def __init__(self, program, entry, oracle, seeds, value_range=(-2**63, 2**63 - 1),
+                 max_array_length=None, fix=None, seed=None):
+        # seeds are inputs of the form {'registers': {...}, 'memory': {...}} like a test
+        # spec case, oracle(inputs) returns what the case should 'expect'.
+        # arrays keep their length unless max_array_length is given, fix(inputs) can
+        # update values that depend on others (e.g. an array length register)
+        self.runner = SpecRunner(program)
+        self.entry = entry
+        self.oracle = oracle
+        self.corpus = [copy_inputs(s) for s in seeds]
+        self.low, self.high = value_range
+        self.max_array_length = max_array_length
+        self.fix = fix
+        self.random = random.Random(seed)
+        self.coverage = EdgeCoverage(len(self.runner.assembler.program.instrs))
+        self.failures = []
+        self.executions = 0
+
+    def execute(self, inputs):
+        # returns (failures, found new coverage)
+        # inputs are a case without its entry and expectations, which are all the
+        # setup and the check look at
+        try:
+            self.runner.setup_case(inputs)
+            self.runner.assembler.unit_test(self.entry, branches=self.coverage)
+            error = self.runner.run_error()
+            if error is None:
+                failures = self.runner.check_case({'expect': self.oracle(inputs)})
+            else:
+                failures = ['error: {}'.format(error)]
+        except Exception as e:
+            failures = ['error: {}'.format(e)]
+        self.executions += 1
+        return failures, self.coverage.commit()
+
+    def below(self, n):
+        # random.randint/randrange/choice are python wrappers that cost more
+        # than running a short routine, one random() call is enough for small n
+        return int(self.random.random() * n)
+
+    def pick(self, items):
+        return items[self.below(len(items))]
+
+    def clamp(self, value):
+        return min(max(value, self.low), self.high)
+
+    def mutate_value(self, value, others):
+        r = self.random.random()
+        if r < 0.3:
+            return self.clamp(value + self.below(33) - 16)
+        if r < 0.5:
+            return self.clamp(value ^ (1 << self.below(64)))
+        if r < 0.7 and others:
+            # copies of other inputs (+-1) reach equality boundaries
+            return self.clamp(self.pick(others) + self.below(3) - 1)
+        if r < 0.85:
+            return self.pick([self.low, self.high, 0, 1, -1 if self.low < 0 else 0])
+        return self.random.randint(self.low, self.high)
+
+    def fields(self, child):
+        # (container, key) of every value that can be mutated, scalar memory
+        # entries (e.g. "SIZE": 4) are values of the memory dict itself
+        registers, memory = child['registers'], child['memory']
+        fields = [(registers, r) for r, v in registers.items() if isinstance(v, int)]
+        for label, values in memory.items():
+            if isinstance(values, list):
+                fields += [(values, i) for i in range(len(values))]
+            else:
+                fields.append((memory, label))
+        return fields
+
+    def mutate(self, inputs):
+        child = copy_inputs(inputs)
+        memory = child['memory']
+        fields = self.fields(child)
+        ints = [container[key] for container, key in fields]
+        arrays = [values for values in memory.values() if isinstance(values, list)]
+        for _ in range(1 + self.below(3)):
+            if self.max_array_length is not None and arrays and self.random.random() < 0.2:
+                values = self.pick(arrays)
+                if len(values) < self.max_array_length and (len(values) <= 1 or self.random.random() < 0.5):
+                    values.insert(self.below(len(values) + 1), self.mutate_value(0, ints))
+                elif len(values) > 1:
+                    del values[self.below(len(values))]
+                fields = self.fields(child)
+            elif fields:
+                container, key = self.pick(fields)
+                container[key] = self.mutate_value(container[key], ints)
+        if self.fix is not None:
+            self.fix(child)
+        return child
+
+    def smaller(self, value):
+        # values closer to 0 to try in place of value
+        if value == 0:
+            return []
+        step = 1 if value > 0 else -1
+        return sorted({0, int(value / 2), value - step}, key=abs)
+
+    def shrink(self, inputs):
+        # greedily moves values towards 0 and drops array elements while the input still fails
+        best = copy_inputs(inputs)
+        improved = True
+        while improved:
+            improved = False
+            # (what, where, new value) where what is 'register', 'scalar' (a memory
+            # entry that is not a list), 'element' (label, index) or 'delete' (label, index)
+            candidates = []
+            for r, v in best['registers'].items():
+                if isinstance(v, int):
+                    candidates += [('register', r, c) for c in self.smaller(v)]
+            for label, values in best['memory'].items():
+                if not isinstance(values, list):
+                    candidates += [('scalar', label, c) for c in self.smaller(values)]
+                    continue
+                for i, v in enumerate(values):
+                    if self.max_array_length is not None and len(values) > 1:
+                        candidates.append(('delete', (label, i), None))
+                    candidates += [('element', (label, i), c) for c in self.smaller(v)]
+            for what, where, value in candidates:
+                child = copy_inputs(best)
+                if what == 'register':
+                    child['registers'][where] = value
+                elif what == 'scalar':
+                    child['memory'][where] = value
+                elif what == 'element':
+                    child['memory'][where[0]][where[1]] = value
+                else:
+                    del child['memory'][where[0]][where[1]]
+                if self.fix is not None:
+                    self.fix(child)
+                if child != best and self.execute(child)[0]:
+                    best = child
+                    improved = True
+                    break
+        return best
+
+    def run(self, executions=None, seconds=None, stop_on_failure=True):
+        # fuzzes until the execution or time budget runs out, failing inputs are
+        # shrunk and collected in self.failures as (inputs, failures)
+        deadline = time.time() + seconds if seconds is not None else None
+        queue = self.corpus
+        self.corpus = []
+        for inputs in queue:
+            failures, _ = self.execute(inputs)
+            self.corpus.append(inputs)
+            if failures:
+                shrunk = self.shrink(inputs)
+                self.failures.append((shrunk, self.execute(shrunk)[0]))
+                if stop_on_failure:
+                    return self.failures
+        start = self.executions
+        while executions is None or self.executions - start < executions:
+            if deadline is not None and self.executions % 64 == 0 and time.time() > deadline:
+                break
+            child = self.mutate(self.pick(self.corpus))
+            failures, new_coverage = self.execute(child)
+            if failures:
+                shrunk = self.shrink(child)
+                self.failures.append((shrunk, self.execute(shrunk)[0]))
+                if stop_on_failure:
+                    break
+            elif new_coverage:
+                self.corpus.append(child)
+        return self.failures
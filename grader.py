@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+# a work queue on a shared directory, nothing but atomic renames is needed:
+#   pending/<shard>.json          shards nobody is working on
+#   claimed/<shard>.json@<worker> shards being graded, the worker keeps touching the file
+#   results/<shard>.json          finished shards
+# a claimed shard that was not touched for --timeout seconds is moved back to pending
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+from spec_runner import SpecRunner, load_spec, summarize
+import result_cache
+
+SHARD_SIZE = 50
+CLAIM_TIMEOUT = 300
+POLL_INTERVAL = 1
+
+
+def queue_dirs(queue):
+    return [os.path.join(queue, d) for d in ('pending', 'claimed', 'results')]
+
+
+def write_json(path, data):
+    # readers never see a partially written file. workers on different
+    # machines can have the same pid, so the host is part of the name
+    tmp_path = '{}.{}-{}.tmp'.format(path, socket.gethostname(), os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def plan(queue, spec_path, submissions, libraries=(), shard_size=SHARD_SIZE):
+    # splits every (submission, test case) pair into shards of about shard_size pairs,
+    # a shard only holds cases of one submission so it is assembled once per shard
+    pending, claimed, results = queue_dirs(queue)
+    for d in (pending, claimed, results):
+        os.makedirs(d, exist_ok=True)
+    spec_path = os.path.abspath(spec_path)
+    libraries = [os.path.abspath(library) for library in libraries]
+    n_cases = len(load_spec(spec_path)['cases'])
+    shards = 0
+    for submission in submissions:
+        for start in range(0, n_cases, shard_size):
+            name = 'shard-{:06d}.json'.format(shards)
+            write_json(os.path.join(pending, name), {
+                'submission': os.path.abspath(submission), 'spec': spec_path, 'libraries': libraries,
+                'cases': list(range(start, min(start + shard_size, n_cases)))})
+            shards += 1
+    return shards
+
+
+def reclaim(queue, timeout=CLAIM_TIMEOUT):
+    # moves shards whose worker stopped touching them back to pending
+    pending, claimed, _ = queue_dirs(queue)
+    now = time.time()
+    for entry in os.scandir(claimed):
+        try:
+            if now - entry.stat().st_mtime > timeout:
+                os.rename(entry.path, os.path.join(pending, entry.name.split('@')[0]))
+        except OSError:
+            # someone else reclaimed or finished it first
+            pass
+
+
+def claim(queue, worker):
+    # returns (shard name, claimed path) or None if nothing is pending
+    pending, claimed, _ = queue_dirs(queue)
+    for name in sorted(os.listdir(pending)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(claimed, '{}@{}'.format(name, worker))
+        try:
+            # the claim time starts now, not when the shard was planned, otherwise
+            # reclaim could move it back before this worker touched it
+            os.utime(os.path.join(pending, name))
+            os.rename(os.path.join(pending, name), path)
+            os.utime(path)
+        except OSError:
+            # claimed by someone else first, or reclaimed right away
+            continue
+        return name, path
+    return None
+
+
+def grade(shard, cache=None, obj_cache_dir=None):
+    # every error ends up in the shard's results, a worker that crashed here would
+    # leave the shard to be reclaimed and crash the next worker the same way
+    cases = [{} for i in shard['cases']]
+    try:
+        spec = load_spec(shard['spec'])
+        cases = [spec['cases'][i] for i in shard['cases']]
+        if shard['libraries']:
+            from linker import build
+            runner = SpecRunner(build(shard['libraries'] + [shard['submission']], obj_cache_dir), cache=cache)
+        else:
+            with open(shard['submission'], 'r') as p:
+                runner = SpecRunner(p, cache=cache)
+        results = runner.run(cases, quiet=True)
+    except Exception as e:
+        # the spec could not be read or the submission did not assemble, every case fails
+        results = [{'name': case.get('name'), 'entry': case.get('entry'), 'passed': False,
+                    'failures': ['error: {}'.format(e)]} for case in cases]
+    for i, result in zip(shard['cases'], results):
+        result['case'] = i
+    return results
+
+
+def heartbeat(path, stop, interval):
+    while not stop.wait(interval):
+        try:
+            os.utime(path)
+        except OSError:
+            return
+
+
+def work(queue, worker=None, timeout=CLAIM_TIMEOUT, wait=True, cache_dir=None, obj_cache_dir=None):
+    # grades shards until none are pending or claimed by anyone, returns how many this worker did.
+    # obj_cache_dir keeps the assembled libraries, see linker.ObjectCache
+    worker = worker or '{}-{}'.format(socket.gethostname(), os.getpid())
+    pending, claimed, results = queue_dirs(queue)
+    cache = result_cache.ResultCache(cache_dir) if cache_dir else None
+    done = 0
+    while True:
+        reclaim(queue, timeout)
+        claimed_shard = claim(queue, worker)
+        if claimed_shard is None:
+            if wait and os.listdir(claimed):
+                # another worker might still die and leave its shard behind
+                time.sleep(POLL_INTERVAL)
+                continue
+            return done
+        name, path = claimed_shard
+        try:
+            with open(path, 'r') as f:
+                shard = json.load(f)
+        except OSError:
+            # the claim was lost to another worker's reclaim
+            continue
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(path, stop, timeout / 3), daemon=True)
+        beat.start()
+        try:
+            write_json(os.path.join(results, name), dict(shard, worker=worker, results=grade(shard, cache, obj_cache_dir)))
+        finally:
+            stop.set()
+            beat.join()
+        try:
+            os.remove(path)
+        except OSError:
+            # the shard was reclaimed meanwhile, the results are the same either way
+            pass
+        done += 1
+
+
+def merge(queue):
+    # combines the finished shards into one report per submission
+    pending, claimed, results = queue_dirs(queue)
+    submissions = {}
+    for name in sorted(os.listdir(results)):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(results, name), 'r') as f:
+            shard = json.load(f)
+        submissions.setdefault(shard['submission'], {})
+        for result in shard['results']:
+            submissions[shard['submission']][result['case']] = result
+    report = {
+        'submissions': [summarize(submission, [cases[i] for i in sorted(cases)]) for submission, cases in sorted(submissions.items())],
+        'unfinished_shards': len(os.listdir(pending)) + len(os.listdir(claimed)),
+    }
+    return report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('plan', help="splits submissions x test cases into shards")
+    p.add_argument("queue", help="shared queue directory")
+    p.add_argument("spec_file", help="json/yaml test spec")
+    p.add_argument("submissions", help="LEGv8 programs to grade", nargs='+')
+    p.add_argument("-l", "--library", help="LEGv8 file linked in front of every submission", action='append', default=[])
+    p.add_argument("--shard-size", help="test cases per shard", type=int, default=SHARD_SIZE)
+    p = subparsers.add_parser('work', help="grades shards until the queue is empty")
+    p.add_argument("queue", help="shared queue directory")
+    p.add_argument("-j", "--processes", help="number of local worker processes", type=int, default=1)
+    p.add_argument("--timeout", help="seconds before a silent worker's shard is reclaimed", type=float, default=CLAIM_TIMEOUT)
+    p.add_argument("--no-wait", help="exit when nothing is pending, even if other workers are still busy", action='store_true')
+    p.add_argument("--cache", help="result cache directory shared by the workers")
+    p.add_argument("--obj-cache", help="directory to keep assembled libraries in, can be shared by the workers")
+    p = subparsers.add_parser('merge', help="combines finished shards into a report")
+    p.add_argument("queue", help="shared queue directory")
+    p.add_argument("-o", "--output", help="writes the json report to a file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.command == 'plan':
+        shards = plan(args.queue, args.spec_file, args.submissions, args.library, args.shard_size)
+        print('Planned {} shards'.format(shards))
+    elif args.command == 'work':
+        work_args = (args.queue, None, args.timeout, not args.no_wait, args.cache, args.obj_cache)
+        if args.processes == 1:
+            done = work(*work_args)
+        else:
+            with multiprocessing.Pool(args.processes) as pool:
+                done = sum(pool.starmap(work, [work_args] * args.processes))
+        print('Graded {} shards'.format(done))
+    elif args.command == 'merge':
+        report = merge(args.queue)
+        if args.output:
+            write_json(args.output, report)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        for submission in report['submissions']:
+            print('{}: {} passed, {} failed'.format(submission['program'], submission['passed'], submission['failed']), file=sys.stderr)
+        if report['unfinished_shards']:
+            print('{} shards are not finished'.format(report['unfinished_shards']), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
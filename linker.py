@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import hashlib
+import json
+import os
+import socket
+
+from assembler import Program, Instruction, terminal_fonts
+
+OBJECT_VERSION = 3
+
+
+class ObjectFile(object):
+    def __init__(self, name, text, raw_asm_lines, source_lines, data_lines, asm_lines, fields,
+                 code_symbols, args, relocations, errors, warnings):
+        # one source file after clean/preprocess, with code label positions
+        # relative to the start of the file
+        self.name = name
+        self.text = text
+        self.raw_asm_lines = raw_asm_lines
+        self.source_lines = source_lines
+        self.data_lines = data_lines
+        self.asm_lines = asm_lines
+        # decoded (operation, operand0, operand1, operand2, extra) of every line
+        self.fields = fields
+        # line of every code label
+        self.code_symbols = code_symbols
+        # resolved operands of every line, see Program.resolve. a code label operand
+        # is its position in this file, or None for a label of another file
+        self.args = args
+        # (line, operand index, label) of every code label operand, fixed up when linking
+        self.relocations = relocations
+        # (line, message) pairs found while resolving, reported when linking
+        self.errors = errors
+        self.warnings = warnings
+
+        self.data_symbols = [d.split(None, 2)[1].upper() for d in data_lines]
+        # code labels of other files used by branches, resolved when linking
+        self.references = {label for _, _, label in relocations if label not in self.code_symbols}
+
+    @classmethod
+    def assemble(cls, text, name='<text>'):
+        lines = Program.clean(text.split('\n'))
+        asm_lines, data_lines = Program.split_sections(lines)
+        raw_asm_lines = [line for _, line in asm_lines]
+        processed = Program.preprocess(raw_asm_lines)
+        instrs = [Instruction(line) for line in processed]
+        code_symbols = Program.line_labels(processed)
+        # labels of other files resolve to None until they are linked
+        labels = dict(code_symbols)
+        relocations = []
+        for i, instr in enumerate(instrs):
+            operand = label_operand(instr)
+            if operand is not None:
+                relocations.append((i,) + operand)
+                labels.setdefault(operand[1], None)
+        errors, warnings = Program.resolve_all(instrs, labels)
+        fields = [(instr.operation, instr.operand0, instr.operand1, instr.operand2, instr.extra) for instr in instrs]
+        return cls(name, text, raw_asm_lines, [ln for ln, _ in asm_lines], [d for _, d in data_lines], processed, fields,
+                   code_symbols, [instr.args for instr in instrs], relocations, errors, warnings)
+
+    def to_dict(self):
+        return {'version': OBJECT_VERSION, 'text': self.text, 'raw_asm_lines': self.raw_asm_lines,
+                'source_lines': self.source_lines, 'data_lines': self.data_lines,
+                'asm_lines': self.asm_lines, 'fields': self.fields, 'code_symbols': self.code_symbols, 'args': self.args,
+                'relocations': self.relocations, 'errors': self.errors, 'warnings': self.warnings}
+
+    @classmethod
+    def from_dict(cls, d, name):
+        # json turns the (base register, offset) of memory operands into lists
+        args = [tuple(tuple(a) if isinstance(a, list) else a for a in line_args) for line_args in d['args']]
+        return cls(name, d['text'], d['raw_asm_lines'], d['source_lines'], d['data_lines'], d['asm_lines'],
+                   [tuple(f) for f in d['fields']], d['code_symbols'], args, [tuple(r) for r in d['relocations']],
+                   [tuple(e) for e in d['errors']], [tuple(w) for w in d['warnings']])
+
+
+def label_operand(instr):
+    # (operand index, label) of the code label an instruction branches to, or None
+    kinds = instr.opcode.operands
+    if 'L' not in kinds:
+        return None
+    operands = instr.operands()
+    if len(operands) != len(kinds) + kinds.count('M'):
+        # resolving it reports the mismatch
+        return None
+    i = kinds.index('L')
+    return i, operands[i + kinds[:i].count('M')]
+
+
+class ObjectCache(object):
+    def __init__(self, directory):
+        # objects are stored by the hash of their source, so a shared library
+        # is only assembled once no matter how many programs link it
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, text):
+        key = hashlib.sha256('{}\n{}'.format(OBJECT_VERSION, text).encode()).hexdigest()
+        return os.path.join(self.directory, key + '.obj.json')
+
+    def assemble(self, text, name='<text>'):
+        path = self.path(text)
+        try:
+            with open(path, 'r') as f:
+                d = json.load(f)
+            if d['version'] == OBJECT_VERSION and d['text'] == text:
+                return ObjectFile.from_dict(d, name)
+        except (OSError, ValueError, KeyError):
+            pass
+        obj = ObjectFile.assemble(text, name)
+        # workers on different machines can have the same pid, so the host is part of the name
+        tmp_path = '{}.{}-{}.tmp'.format(path, socket.gethostname(), os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(obj.to_dict(), f)
+        os.replace(tmp_path, path)
+        return obj
+
+
+def assemble(source, name=None, cache=None):
+    # source is a file name or an open file
+    if isinstance(source, str):
+        name = name or source
+        with open(source, 'r') as f:
+            text = f.read()
+    else:
+        name = name or getattr(source, 'name', '<text>')
+        text = source.read()
+    if cache is not None:
+        return cache.assemble(text, name)
+    return ObjectFile.assemble(text, name)
+
+
+def link(objects):
+    # lays the objects out one after another, in order, so the first object
+    # is where execution starts. the objects are already resolved, only their
+    # code label operands are moved by where the object starts
+    raw_asm_lines, source_lines, data_lines, asm_lines = [], [], [], []
+    errors, warnings = [], []
+    code_symbols = {}
+    data_symbols = {}
+    # position of every code label in the linked program, and where each object starts
+    positions = {}
+    bases = []
+    for obj in objects:
+        for symbols, defined in ((obj.code_symbols, code_symbols), (obj.data_symbols, data_symbols)):
+            for symbol in symbols:
+                if symbol in defined:
+                    raise ValueError(terminal_fonts.to_error("Label '{}' is defined in both {} and {}".format(symbol, defined[symbol], obj.name)))
+                defined[symbol] = obj.name
+        base = len(asm_lines)
+        bases.append(base)
+        positions.update((symbol, base + line) for symbol, line in obj.code_symbols.items())
+        errors += [(base + line, error) for line, error in obj.errors]
+        warnings += [(base + line, warning) for line, warning in obj.warnings]
+        raw_asm_lines += obj.raw_asm_lines
+        source_lines += ['{}:{}'.format(obj.name, ln) for ln in obj.source_lines]
+        data_lines += obj.data_lines
+        asm_lines += obj.asm_lines
+    # data labels can still be added at run time (Memory.insert), so only code labels are checked
+    undefined = sorted({r for obj in objects for r in obj.references} - set(code_symbols))
+    if undefined:
+        raise ValueError(terminal_fonts.to_error('Undefined labels: {}'.format(', '.join(undefined))))
+    Program.report(errors, warnings, source_lines, raw_asm_lines)
+    instrs = []
+    for obj, base in zip(objects, bases):
+        args = [list(line_args) for line_args in obj.args]
+        for line, i, label in obj.relocations:
+            if label in obj.code_symbols:
+                args[line][i] += base
+            else:
+                args[line][i] = positions[label]
+        for line, fields, line_args in zip(obj.asm_lines, obj.fields, args):
+            instr = Instruction.from_fields(line, *fields)
+            instr.set_args(line_args)
+            instrs.append(instr)
+    return Program.from_parts('\n'.join(obj.text for obj in objects), raw_asm_lines, source_lines, data_lines, asm_lines,
+                              instrs, positions)
+
+
+def build(sources, cache_dir=None):
+    cache = ObjectCache(cache_dir) if cache_dir else None
+    return link([assemble(source, cache=cache) for source in sources])
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import argparse
+import mmap
+import struct
+import sys
+
+from assembler import to_signed
+
+TRACE_MAGIC = b'LEGTRACE'
+TRACE_VERSION = 1
+HEADER = struct.Struct('<8sI4x')
+# pc, access kind, effective address, value. registers hold any 64 bit pattern,
+# the trace keeps them as signed doublewords
+RECORD = struct.Struct('<IIqq')
+
+READ = 0
+WRITE = 1
+
+
+class MemoryTraceWriter(object):
+    def __init__(self, path, chunk_records=4096):
+        # records are packed into a fixed size buffer that is written out
+        # whenever it fills up, so memory use does not depend on the run length
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+        self.chunk_records = chunk_records
+        self.chunk = bytearray(RECORD.size * chunk_records)
+        self.fill = 0
+        self.count = 0
+
+    def record(self, pc, kind, address, value):
+        RECORD.pack_into(self.chunk, self.fill * RECORD.size, pc, kind, to_signed(address), to_signed(value))
+        self.fill += 1
+        if self.fill == self.chunk_records:
+            self.flush()
+
+    def record_read(self, pc, address, value):
+        self.record(pc, READ, address, value)
+
+    def record_write(self, pc, address, value):
+        self.record(pc, WRITE, address, value)
+
+    def flush(self):
+        self.file.write(memoryview(self.chunk)[:self.fill * RECORD.size])
+        self.count += self.fill
+        self.fill = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MemoryTraceReader(object):
+    def __init__(self, path):
+        # the trace is memory mapped so large traces can be replayed without
+        # being loaded into python objects first
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = HEADER.unpack_from(self.map, 0)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            self.close()
+            raise ValueError('{} is not a memory trace (version {})'.format(path, TRACE_VERSION))
+        self.records = memoryview(self.map)[HEADER.size:]
+
+    def __len__(self):
+        return len(self.records) // RECORD.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not (0 <= i < len(self)):
+            raise IndexError('trace record out of range: {}'.format(i))
+        return RECORD.unpack_from(self.records, i * RECORD.size)
+
+    def __iter__(self):
+        return RECORD.iter_unpack(self.records)
+
+    def replay(self, access):
+        # calls access(pc, kind, address, value) for every record in order
+        for pc, kind, address, value in self:
+            access(pc, kind, address, value)
+
+    def close(self):
+        if getattr(self, 'records', None) is not None:
+            self.records.release()
+            self.records = None
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace_file", help="name of the memory trace file")
+    parser.add_argument("-n", help="only print the first N records", type=int)
+    args = parser.parse_args(argv)
+    with MemoryTraceReader(args.trace_file) as trace:
+        reads = 0
+        for i, (pc, kind, address, value) in enumerate(trace):
+            reads += kind == READ
+            if args.n is None or i < args.n:
+                print('{:10d}: {} 0x{:016X} {}'.format(pc, 'R' if kind == READ else 'W', address & 0xFFFFFFFFFFFFFFFF, value))
+        print('Records: {}, Reads: {}, Writes: {}'.format(len(trace), reads, len(trace) - reads))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
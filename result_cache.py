@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import hashlib
+import json
+import os
+import socket
+
+CACHE_SIZE = 64 * 1024 * 1024
+# part of every key, bump it whenever a change to the emulator can change the
+# result of a run (e.g. an instruction fix) so older results are not served
+CACHE_VERSION = 3
+
+
+def program_key(assembler):
+    # the program after clean/preprocess and its initial data image, so
+    # submissions that only differ in comments, spacing or case share a key
+    program = assembler.program
+    h = hashlib.sha256()
+    for instr in program.instrs:
+        h.update(str(instr).encode())
+        h.update(b'\n')
+    h.update(json.dumps(sorted(program.data_labels.items())).encode())
+    h.update(json.dumps(sorted(program.data.items())).encode())
+    return h.hexdigest()
+
+
+def inputs_key(program, entry, inputs):
+    # inputs is anything json serializable describing the run, e.g. a test case without its expectations
+    encoded = json.dumps({'version': CACHE_VERSION, 'entry': entry.upper(), 'inputs': inputs}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256((program + encoded).encode()).hexdigest()
+
+
+def capture(assembler, initial_state, error=None, memory_errors=(), stack=None):
+    # the final state as a diff against the state the run started from
+    registers, flags, memory, labels, label_ends, offset, console_buffer, visits = initial_state
+    f = assembler.flags
+    return {
+        'registers': list(assembler.registers.data),
+        'flags': [f.N, f.C, f.Z, f.V],
+        'memory': [[address, b] for address, b in assembler.memory.data.items() if memory.get(address) != b],
+        'labels': {label: address for label, address in assembler.memory.labels.items() if labels.get(label) != address},
+        'label_ends': {label: end for label, end in assembler.memory.label_ends.items() if label_ends.get(label) != end},
+        'offset': assembler.memory.offset,
+        'console': assembler.console_buffer,
+        'error': error,
+        'memory_errors': list(memory_errors),
+        'stack': stack or {},
+    }
+
+
+def apply(assembler, initial_state, result):
+    # puts the machine in the final state of a cached run
+    assembler.load_state(initial_state)
+    assembler.registers.data[:] = result['registers']
+    N, C, Z, V = result['flags']
+    assembler.flags.update(N=N, C=C, Z=Z, V=V)
+    for address, b in result['memory']:
+        assembler.memory.data[address] = b
+    assembler.memory.labels.update(result['labels'])
+    assembler.memory.label_ends.update(result.get('label_ends', {}))
+    assembler.memory.offset = result['offset']
+    assembler.console_buffer = result['console']
+
+
+def file_size(path):
+    # 0 for a file another worker removed
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class ResultCache(object):
+    def __init__(self, directory, max_bytes=CACHE_SIZE):
+        # one json file per result, the least recently used files are
+        # removed once the directory grows past max_bytes
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.entries())
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def entries(self):
+        # (mtime, size, path) of every result. other workers sharing the directory
+        # can remove or replace an entry at any time, those are skipped
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'r') as f:
+                result = json.load(f)
+            # mark as recently used
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            # missing, or evicted by another worker while it was read
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        path = self.path(key)
+        # workers on different machines can have the same pid, so the host is part of the name
+        tmp_path = '{}.{}-{}.tmp'.format(path, socket.gethostname(), os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(result, f, separators=(',', ':'))
+            old_size = file_size(path)
+            os.replace(tmp_path, path)
+        except OSError:
+            # the result is just not cached
+            return
+        self.size += file_size(path) - old_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self.entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes:
+                break
+            # gone either way if another worker removed it first
+            self.size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.size = 0
+
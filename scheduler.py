@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+# runs many machines in one asyncio event loop, each machine runs for a
+# quantum of instructions and then lets the others run, in turn
+
+import asyncio
+
+QUANTUM = 1000
+
+
+class Scheduler(object):
+    def __init__(self, quantum=QUANTUM, max_instructions=None):
+        # max_instructions stops machines that run longer than that, they are
+        # left with halted == False
+        self.quantum = quantum
+        self.max_instructions = max_instructions
+
+    async def run(self, machine, **run_args):
+        # runs a machine from its pc (see Assembler.start/enter) until it halts,
+        # returns the number of instructions it ran. run_args are passed to Assembler.run.
+        # a machine that faults stops with the exception in machine.error,
+        # the others keep running
+        executed = 0
+        while not machine.halted:
+            quantum = self.quantum
+            if self.max_instructions is not None:
+                quantum = min(quantum, self.max_instructions - executed)
+                if quantum <= 0:
+                    break
+            try:
+                executed += machine.run_for(quantum, **run_args)
+            except Exception as e:
+                machine.error = e
+                break
+            # every other machine gets its quantum before this one runs again
+            await asyncio.sleep(0)
+        return executed
+
+    async def call(self, machine, label, args=(), returns=1, **run_args):
+        # Assembler.call, but sliced. returns None if the machine was stopped or faulted
+        machine.enter(label, args)
+        await self.run(machine, **run_args)
+        if not machine.halted or machine.error is not None:
+            return None
+        if returns == 1:
+            return machine.registers[0]
+        return [machine.registers[i] for i in range(returns)]
+
+    async def gather(self, machines, **run_args):
+        return await asyncio.gather(*[self.run(machine, **run_args) for machine in machines])
+
+
+def run_all(machines, quantum=QUANTUM, max_instructions=None, **run_args):
+    # runs every machine to completion in a new event loop, returns how many instructions each ran.
+    # see machine.error for the machines that faulted
+    return asyncio.run(Scheduler(quantum, max_instructions).gather(machines, **run_args))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import bisect
+
+UNINITIALIZED = 'uninitialized read'
+OUT_OF_RANGE = 'out of range'
+UNALIGNED = 'unaligned access'
+
+MAX_VIOLATIONS = 100
+
+
+class ShadowMemory(object):
+    def __init__(self, max_violations=MAX_VIOLATIONS):
+        # one bit per byte of the data section and of the stack tells if the
+        # byte was ever written, doubleword aligned accesses check one whole
+        # byte of a bitmap. violations are (pc, kind, address, is write)
+        self.max_violations = max_violations
+        self.violations = []
+        self.count = 0
+        self.machine = None
+        # the stack bitmap is kept across runs, it starts at the first SP seen
+        self.stack_top = None
+        self.stack_bits = bytearray()
+
+    def attach(self, machine):
+        # called when a run starts: the data section is everything inserted
+        # so far and the stack is everything between SP and its current value
+        self.machine = machine
+        memory = machine.memory
+        self.data_base = memory.default_offset
+        self.data_bits = bytearray((max(memory.offset - self.data_base, 0) + 7) // 8)
+        for address in memory.data:
+            i = address - self.data_base
+            if 0 <= i < memory.offset - self.data_base:
+                self.data_bits[i >> 3] |= 1 << (i & 7)
+        # [start, end) of every data label sorted by start, see locate
+        ranges = sorted((start, memory.label_ends.get(label, start)) for label, start in memory.labels.items())
+        self.label_starts = [start for start, _ in ranges]
+        self.label_ends = [end for _, end in ranges]
+        if self.stack_top is None:
+            self.stack_top = machine.registers['SP']
+        self.last_sp = machine.registers['SP']
+
+    def report_violation(self, pc, kind, address, write):
+        self.count += 1
+        if len(self.violations) < self.max_violations:
+            self.violations.append((pc, kind, address, write))
+
+    def locate(self, address, size=8, base=None):
+        # returns (bitmap, bit index of the lowest byte) for a size byte access,
+        # or None if the access is not completely inside the data section or the stack.
+        # base is the value of the base register, an access with a positive offset
+        # may not run past the end of the label the base points into (e.g. A[4] of a
+        # 4 element A is out of range even if another label follows A)
+        memory = self.machine.memory
+        if self.data_base <= address and address + size <= memory.offset:
+            start = address if base is None else min(base, address)
+            label = bisect.bisect_right(self.label_starts, start) - 1
+            if label >= 0 and start < self.label_ends[label] < address + size:
+                return None
+            size = (memory.offset - self.data_base + 7) // 8
+            if len(self.data_bits) < size:
+                self.data_bits.extend(bytes(size - len(self.data_bits)))
+            return self.data_bits, address - self.data_base
+        sp = self.machine.registers['SP']
+        self.sp_written(sp)
+        if sp <= address and address + size <= self.stack_top:
+            # the stack bitmap grows down from the top of the stack
+            i = self.stack_top - size - address
+            length = (i + size + 7) // 8
+            if len(self.stack_bits) < length:
+                self.stack_bits.extend(bytes(length - len(self.stack_bits)))
+            return self.stack_bits, i
+        return None
+
+    def sp_written(self, sp):
+        # called by the machine after every instruction that writes SP,
+        # everything popped is no longer initialized
+        if sp > self.last_sp:
+            self.clear_stack(self.last_sp, sp)
+        self.last_sp = sp
+
+    def clear_stack(self, low, high):
+        for address in range(max(low, self.stack_top - 8 * len(self.stack_bits)), min(high, self.stack_top)):
+            i = self.stack_top - 1 - address
+            self.stack_bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+    def check_read(self, pc, address, size=8, base=None):
+        location = self.locate(address, size, base)
+        if location is None:
+            self.report_violation(pc, OUT_OF_RANGE, address, False)
+            return
+        bits, i = location
+        if size == 8 and not i & 7:
+            initialized = bits[i >> 3] == 0xFF
+        else:
+            if i & (size - 1):
+                self.report_violation(pc, UNALIGNED, address, False)
+            initialized = all(bits[j >> 3] & (1 << (j & 7)) for j in range(i, i + size))
+        if not initialized:
+            self.report_violation(pc, UNINITIALIZED, address, False)
+
+    def check_write(self, pc, address, size=8, base=None):
+        location = self.locate(address, size, base)
+        if location is None:
+            self.report_violation(pc, OUT_OF_RANGE, address, True)
+            return
+        bits, i = location
+        if size == 8 and not i & 7:
+            bits[i >> 3] = 0xFF
+        else:
+            if i & (size - 1):
+                self.report_violation(pc, UNALIGNED, address, True)
+            for j in range(i, i + size):
+                bits[j >> 3] |= 1 << (j & 7)
+
+    def messages(self):
+        ret = []
+        for pc, kind, address, write in self.violations:
+            line = self.machine.source_line(pc) if self.machine is not None else None
+            ret.append('{}{} at 0x{:X}: "{}" at line {}'.format(
+                kind, ' (write)' if write else '', address & 0xFFFFFFFFFFFFFFFF, self.machine.instrs[pc], line))
+        if self.count > len(self.violations):
+            ret.append('... and {} more'.format(self.count - len(self.violations)))
+        return ret
+
+    def report(self):
+        ret = 'Memory Check: {} problem(s)\n'.format(self.count)
+        for message in self.messages():
+            ret += '\t{}\n'.format(message)
+        return ret
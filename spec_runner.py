@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+from assembler import Assembler, StackOverflowError, MAX_REVISIT_DEPTH, terminal_fonts
+from shadow import ShadowMemory
+import result_cache
+import statediff
+
+
+def load_spec(path):
+    # test specs are json, or yaml if pyyaml is installed
+    with open(path, 'r') as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if spec.get('program') is not None:
+        spec['program'] = os.path.join(os.path.dirname(path), spec['program'])
+    return spec
+
+
+class SpecRunner(object):
+    def __init__(self, program, verbose=0, hooks=None, cache=None, check_memory=False, lazy=False):
+        # the program is only assembled once, every case starts from a copy
+        # of the state right after assembly. with lazy, only the code the
+        # cases reach is decoded
+        self.assembler = Assembler(program, lazy)
+        self.initial_state = self.assembler.save_state()
+        self.verbose = verbose
+        # python hooks used for every case, see Assembler.active_hooks
+        self.hooks = hooks
+        # an optional result_cache.ResultCache, runs with python hooks are never cached
+        self.cache = cache
+        self.program_key = result_cache.program_key(self.assembler) if cache is not None else None
+        # memory problems found by a shadow.ShadowMemory count as failures
+        self.check_memory = check_memory
+
+    def resolve(self, value):
+        return statediff.resolve(self.assembler, value)
+
+    def setup_case(self, case):
+        a = self.assembler
+        a.load_state(self.initial_state)
+        for label, values in case.get('memory', {}).items():
+            if not isinstance(values, list):
+                values = [values]
+            a.memory.insert_values(label, [int(v) for v in values])
+        for register, value in case.get('registers', {}).items():
+            if not statediff.is_register(register):
+                raise ValueError('{}: unknown register'.format(register))
+            a.registers[register] = self.resolve(value)
+        a.set_input(case.get('input', ''))
+        a.stack_limit = case.get('stack_limit')
+        a.call_depth_limit = case.get('call_depth_limit')
+        a.max_revisits = case.get('max_revisits', MAX_REVISIT_DEPTH)
+
+    def check_case(self, case):
+        # one failure per register, flag and console mismatch, and one per memory
+        # label pointing at its first wrong element
+        return statediff.summarize(statediff.compare(self.assembler, case.get('expect', {})))
+
+    def run_error(self):
+        # a case only passes if its routine returned. an infinite loop, too many
+        # revisits or a stack overflow stop the run without raising
+        error = self.assembler.error
+        if isinstance(error, StackOverflowError):
+            return 'stack overflow: {}'.format(error)
+        if error is not None:
+            return str(error)
+        if not self.assembler.halted:
+            return 'the routine did not return'
+        return None
+
+    def execute_case(self, case):
+        # runs the case, or loads its final state from the cache,
+        # returns the error if any and the memory problems found
+        key = None
+        if self.cache is not None and not self.verbose and not self.assembler.active_hooks(self.hooks):
+            inputs = {k: v for k, v in case.items() if k not in ('name', 'expect')}
+            inputs['check_memory'] = self.check_memory
+            key = result_cache.inputs_key(self.program_key, case['entry'], inputs)
+            result = self.cache.get(key)
+            if result is not None:
+                result_cache.apply(self.assembler, self.initial_state, result)
+                return result['error'], result['memory_errors'], result.get('stack', {})
+        shadow = ShadowMemory() if self.check_memory else None
+        error = None
+        try:
+            # a typo in the case fails that case only
+            self.setup_case(case)
+            self.assembler.unit_test(case['entry'], self.verbose, hooks=self.hooks, shadow=shadow)
+        except Exception as e:
+            error = str(e)
+        if error is None:
+            error = self.run_error()
+        memory_errors = shadow.messages() if shadow is not None else []
+        stack = self.assembler.stack_usage()
+        if key is not None:
+            self.cache.put(key, result_cache.capture(self.assembler, self.initial_state, error, memory_errors, stack))
+        return error, memory_errors, stack
+
+    def run_case(self, case):
+        error, memory_errors, stack = self.execute_case(case)
+        if error is None:
+            failures = self.check_case(case)
+        else:
+            failures = ['error: {}'.format(error)]
+        failures += ['memory: {}'.format(message) for message in memory_errors]
+        return {'name': case.get('name'), 'entry': case['entry'], 'passed': not failures, 'failures': failures,
+                'stack_bytes': stack.get('stack_bytes'), 'max_call_depth': stack.get('max_call_depth')}
+
+    def run(self, cases, quiet=False):
+        results = []
+        test_numbers = {}
+        for case in cases:
+            result = self.run_case(case)
+            test_numbers[result['entry']] = test_numbers.get(result['entry'], 0) + 1
+            result['test'] = test_numbers[result['entry']]
+            if result['name'] is None:
+                result['name'] = '{} #{}'.format(result['entry'], result['test'])
+            results.append(result)
+            if not quiet:
+                print_result(result)
+        return results
+
+
+def print_result(result, details=True):
+    if result['passed']:
+        print(terminal_fonts.to_ok('UUT: {} | Test: {} | passed'.format(result['entry'], result['test'])))
+    else:
+        print(terminal_fonts.to_error('UUT: {} | Test: {} | failed'.format(result['entry'], result['test'])))
+        if details:
+            for failure in result['failures']:
+                print('    {}'.format(failure))
+
+
+def print_summary(results):
+    print('-------------------- Test Summary --------------------')
+    entry = None
+    for result in results:
+        if entry is not None and result['entry'] != entry:
+            print()
+        entry = result['entry']
+        print_result(result, details=False)
+    print()
+    passed = sum(result['passed'] for result in results)
+    print('Passed: {} / {}'.format(passed, len(results)))
+
+
+def summarize(program, results):
+    passed = sum(result['passed'] for result in results)
+    return {'program': program, 'passed': passed, 'failed': len(results) - passed, 'cases': results}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spec_file", help="name of the json/yaml test spec")
+    parser.add_argument("-p", "--program", help="LEGv8 program to test, overrides the program in the spec")
+    parser.add_argument("-l", "--library", help="LEGv8 file linked in front of the program (e.g. a test driver), can be repeated", action='append', default=[])
+    parser.add_argument("--obj-cache", help="directory to keep assembled libraries in")
+    parser.add_argument("-v", "--verbose", help="prints status of registers and memory", action='count', default=0)
+    parser.add_argument("-q", "--quiet", help="only prints the summary", action='store_true')
+    parser.add_argument("--lazy", help="only decodes the instructions the cases reach", action='store_true')
+    parser.add_argument("--check-memory", help="fails cases with uninitialized, out of range or unaligned memory accesses", action='store_true')
+    parser.add_argument("--json", help="writes a machine readable summary to a file ('-' for stdout)")
+    parser.add_argument("--cache", help="directory of cached results, cases already run with the same program and inputs are not run again")
+    parser.add_argument("--cache-size", help="maximum size of the result cache in MB", type=int, default=result_cache.CACHE_SIZE // (1024 * 1024))
+    args = parser.parse_args(argv)
+
+    spec = load_spec(args.spec_file)
+    program = args.program or spec.get('program')
+    if program is None:
+        parser.error('the spec does not name a program, use --program')
+    if args.lazy and args.library:
+        # linked objects are decoded when they are assembled
+        parser.error('--lazy cannot be used with --library')
+    cache = None
+    if args.cache:
+        cache = result_cache.ResultCache(args.cache, args.cache_size * 1024 * 1024)
+    # with the summary on stdout, whatever assembly and the runs print goes to
+    # stderr so stdout stays valid json
+    output = contextlib.redirect_stdout(sys.stderr) if args.json == '-' else contextlib.nullcontext()
+    with output:
+        try:
+            if args.library:
+                from linker import build
+                runner = SpecRunner(build(args.library + [program], args.obj_cache), verbose=args.verbose, cache=cache,
+                                    check_memory=args.check_memory)
+            else:
+                with open(program, 'r') as p:
+                    runner = SpecRunner(p, verbose=args.verbose, cache=cache, check_memory=args.check_memory, lazy=args.lazy)
+        except (SyntaxError, ValueError) as e:
+            # the program did not assemble, so no case can run
+            print(e)
+            return 1
+        results = runner.run(spec['cases'], quiet=args.quiet or args.json == '-')
+
+    if args.json == '-':
+        json.dump(summarize(program, results), sys.stdout, indent=2)
+        print()
+    else:
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(summarize(program, results), f, indent=2)
+        print()
+        print_summary(results)
+    return 0 if all(result['passed'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+import argparse
+import struct
+import sys
+
+from assembler import Assembler, Registers, terminal_fonts
+
+WORD = 8
+FLAGS = ('N', 'C', 'Z', 'V')
+
+
+class Difference(object):
+    def __init__(self, kind, name, expected, actual, address=None, label=None):
+        # kind is 'register', 'flag', 'memory', 'console', 'label' (an unknown memory label),
+        # 'register name' (an unknown register) or 'flag name' (an unknown flag).
+        # memory differences have the address of the doubleword and, inside a label range, the label
+        self.kind = kind
+        self.name = name
+        self.expected = expected
+        self.actual = actual
+        self.address = address
+        self.label = label
+
+    def __str__(self):
+        if self.kind == 'label':
+            return '{}: unknown memory label'.format(self.name)
+        if self.kind == 'register name':
+            return '{}: unknown register'.format(self.name)
+        if self.kind == 'flag name':
+            return '{}: unknown flag'.format(self.name)
+        if self.kind == 'console':
+            return 'console: expected {!r}, got {!r} (first difference at character {})'.format(
+                self.expected, self.actual, first_difference(self.expected, self.actual))
+        name = self.name
+        if self.label is not None:
+            name = '{} (0x{:016X})'.format(name, self.address)
+        return '{}: expected {}, got {}'.format(name, self.expected, self.actual)
+
+    def __repr__(self):
+        return 'Difference({!r}, {!r}, {!r}, {!r})'.format(self.kind, self.name, self.expected, self.actual)
+
+
+def first_difference(x, y):
+    # index of the first element that differs, or None if equal. halves the
+    # range every step so large inputs take a few slice compares, not a loop
+    n = min(len(x), len(y))
+    if x[:n] == y[:n]:
+        return None if len(x) == len(y) else n
+    low, high = 0, n
+    while high - low > 1:
+        middle = (low + high) // 2
+        if x[low:middle] != y[low:middle]:
+            high = middle
+        else:
+            low = middle
+    return low
+
+
+def resolve(machine, value):
+    # register values can name a memory label to use its address
+    if isinstance(value, str):
+        if value.upper() not in machine.memory.labels:
+            raise ValueError('{}: unknown memory label'.format(value))
+        return machine.memory.labels[value.upper()]
+    return int(value)
+
+
+def is_register(name):
+    return str(name).upper() in Registers.conversion_dict
+
+
+def register_name(index):
+    for name in ('SP', 'FP', 'LR', 'XZR'):
+        if Registers.conversion_dict[name] == index:
+            return name
+    return 'X{}'.format(index)
+
+
+def diff_registers(expected, actual):
+    if expected == actual:
+        return []
+    return [Difference('register', register_name(i), e, a) for i, (e, a) in enumerate(zip(expected, actual)) if e != a]
+
+
+def diff_memory(expected, actual, data_end=None, stack_top=None):
+    # expected and actual are Memory.data byte dicts. the common case of equal
+    # memory is a single dict compare, otherwise the changed bytes come from
+    # the symmetric difference of the item views and are reported per doubleword.
+    # doublewords are aligned to 8 bytes like the data section, or to stack_top
+    # closer to the stack than to data_end, since SP starts at a value that is not
+    # a multiple of 8
+    if expected == actual:
+        return []
+    changed = sorted({address for address, b in expected.items() ^ actual.items()
+                      if expected.get(address, 0) != actual.get(address, 0)})
+    stack = (data_end + stack_top) // 2 if data_end is not None and stack_top is not None else None
+    differences = []
+    end = None
+    for address in changed:
+        base = stack_top if stack is not None and address > stack else 0
+        start = address - (address - base) % WORD
+        if end is not None and start < end:
+            continue
+        end = start + WORD
+        differences.append(Difference('memory', '0x{:016X}'.format(start), word(expected, start), word(actual, start), start))
+    return differences
+
+
+def word(data, address):
+    return struct.unpack('<q', bytes(data.get(address + i, 0) for i in range(WORD)))[0]
+
+
+def diff(expected, actual, memory=True):
+    # every difference between the state of two machines, e.g. a reference
+    # solution and a submission after the same run
+    differences = diff_registers(expected.registers.data, actual.registers.data)
+    differences += [Difference('flag', flag, getattr(expected.flags, flag), getattr(actual.flags, flag))
+                    for flag in FLAGS if getattr(expected.flags, flag) != getattr(actual.flags, flag)]
+    if memory:
+        differences += diff_memory(expected.memory.data, actual.memory.data,
+                                   max(expected.memory.offset, actual.memory.offset), actual.stack_top)
+    if expected.console_buffer != actual.console_buffer:
+        differences.append(Difference('console', 'console', expected.console_buffer, actual.console_buffer))
+    return differences
+
+
+def compare(machine, expect):
+    # differences between a machine and an expected image in the format of
+    # a test spec's 'expect': registers, flags, memory label ranges and console
+    differences = []
+    for register, value in expect.get('registers', {}).items():
+        if not is_register(register):
+            differences.append(Difference('register name', register, value, None))
+            continue
+        if isinstance(value, str) and value.upper() not in machine.memory.labels:
+            differences.append(Difference('label', value, None, None))
+            continue
+        expected = resolve(machine, value)
+        actual = machine.registers[register]
+        if actual != expected:
+            differences.append(Difference('register', register, expected, actual))
+    for flag, value in expect.get('flags', {}).items():
+        if flag.upper() not in FLAGS:
+            differences.append(Difference('flag name', flag, value, None))
+        elif getattr(machine.flags, flag.upper()) != value:
+            differences.append(Difference('flag', flag.upper(), value, getattr(machine.flags, flag.upper())))
+    for label, values in expect.get('memory', {}).items():
+        if not isinstance(values, list):
+            values = [values]
+        if label.upper() not in machine.memory.labels:
+            differences.append(Difference('label', label, None, None))
+            continue
+        differences += compare_range(machine.memory, label, values)
+    if 'console' in expect and machine.console_buffer != expect['console']:
+        differences.append(Difference('console', 'console', expect['console'], machine.console_buffer))
+    return differences
+
+
+def compare_range(memory, label, values):
+    # the whole range is compared as one bytes object, only a mismatch
+    # goes through it doubleword by doubleword from the first difference
+    base = memory.labels[label.upper()]
+    expected = struct.pack('<{}Q'.format(len(values)), *(v & 0xFFFFFFFFFFFFFFFF for v in values))
+    actual = memory.read(base, len(expected))
+    start = first_difference(expected, actual)
+    if start is None:
+        return []
+    differences = []
+    for i in range(start // WORD, len(values)):
+        offset = i * WORD
+        if expected[offset:offset + WORD] != actual[offset:offset + WORD]:
+            differences.append(Difference('memory', '{}[{}]'.format(label, i), values[i], memory[base + offset], base + offset, label))
+    return differences
+
+
+def summarize(differences):
+    # one line per register, flag and console difference, and one per memory
+    # label range pointing at its first differing element
+    lines = []
+    ranges = {}
+    for d in differences:
+        if d.label is not None:
+            if d.label in ranges:
+                ranges[d.label][1] += 1
+                continue
+            ranges[d.label] = [len(lines), 1]
+        lines.append(str(d))
+    for index, count in ranges.values():
+        if count > 1:
+            lines[index] += ' ({} elements differ)'.format(count)
+    return lines
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("expected_file", help="LEGv8 program giving the expected state, e.g. a reference solution")
+    parser.add_argument("actual_file", help="LEGv8 program to compare with it")
+    parser.add_argument("--entry", help="label of the routine to call in both instead of running from the start")
+    parser.add_argument("--args", help="arguments passed in X0, X1, ... with --entry", type=int, nargs='*', default=[])
+    parser.add_argument("--input", help="console input of both runs", default='')
+    parser.add_argument("--no-memory", help="only compares registers, flags and the console", action='store_true')
+    args = parser.parse_args(argv)
+    machines = []
+    for file_name in (args.expected_file, args.actual_file):
+        try:
+            a = Assembler(open(file_name, 'r'))
+        except (SyntaxError, ValueError) as e:
+            sys.exit(str(e))
+        a.set_input(args.input)
+        if args.entry:
+            a.call(args.entry, args.args)
+        else:
+            a.run()
+        machines.append(a)
+    differences = diff(*machines, memory=not args.no_memory)
+    for line in summarize(differences):
+        print(line)
+    if differences:
+        print(terminal_fonts.to_error('{} difference(s)'.format(len(differences))))
+        return 1
+    print(terminal_fonts.to_ok('same state'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
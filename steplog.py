@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+'''
+Copyright (c) 2020 Spencer Chang
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+# a step log has one json object per line:
+#   the first line is the full machine state before the run
+#   {"registers": [...], "flags": [N, C, Z, V], "memory": [[address, byte], ...], "output": ""}
+#   every other line is one executed instruction and only what it changed
+#   {"step": n, "pc": pc, "r": [register, value], "m": [address, value], "f": [N, C, Z, V], "o": "text"}
+#   byte stores log "b": [address, byte] instead of "m"
+#   hooks, stepping back and whatever happens between two runs (call arguments,
+#   spec setup) can change anything, so they log the full state as "state"
+
+import argparse
+import json
+import sys
+
+from assembler import Memory, Registers, Flags, LR
+
+LOG_BUFFER_SIZE = 1 << 20
+REGISTER_NAMES = {i: name for name, i in Registers.conversion_dict.items() if name[0] == 'X' and name[1:].isdigit()}
+
+
+def machine_state(machine):
+    f = machine.flags
+    return {'registers': list(machine.registers.data), 'flags': [f.N, f.C, f.Z, f.V],
+            'memory': sorted(machine.memory.data.items()), 'output': machine.console_buffer}
+
+
+class StepLogWriter(object):
+    def __init__(self, path, buffer_size=LOG_BUFFER_SIZE):
+        # lines go through a large write buffer, the run only waits on the disk
+        # when the buffer fills up
+        self.file = open(path, 'w', buffering=buffer_size)
+        self.encoder = json.JSONEncoder(separators=(',', ':'))
+        self.steps = 0
+        self.output_length = None
+
+    def start(self, machine, pc=0, new_run=True):
+        # the first line of a log is written before the first step, every later
+        # new run starts with a snapshot of what changed since the last one
+        if self.output_length is None:
+            self.file.write(self.encoder.encode(machine_state(machine)) + '\n')
+            self.output_length = len(machine.console_buffer)
+        elif new_run:
+            self.snapshot(machine, pc)
+
+    def record(self, machine, pc, instr):
+        step = {'step': self.steps, 'pc': pc}
+        opcode = instr.opcode
+        if opcode.writes:
+            register = instr.args[0]
+            step['r'] = [register, machine.registers[register]]
+        elif opcode.name == 'BL':
+            register = LR
+            step['r'] = [register, machine.registers[register]]
+        elif opcode.name == 'STUR':
+            address = machine.effective_address(instr.args[1])
+            step['m'] = [address, machine.memory[address]]
+        elif opcode.name == 'STURB':
+            address = machine.effective_address(instr.args[1])
+            step['b'] = [address, machine.memory.load_byte(address)]
+        if opcode.changes_flags:
+            f = machine.flags
+            step['f'] = [f.N, f.C, f.Z, f.V]
+        if len(machine.console_buffer) != self.output_length:
+            step['o'] = machine.console_buffer[self.output_length:]
+            self.output_length = len(machine.console_buffer)
+        self.file.write(self.encoder.encode(step) + '\n')
+        self.steps += 1
+
+    def snapshot(self, machine, pc):
+        # for changes that are not described by the instruction itself
+        self.file.write(self.encoder.encode({'step': self.steps, 'pc': pc, 'state': machine_state(machine)}) + '\n')
+        self.output_length = len(machine.console_buffer)
+        self.steps += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StepLogState(object):
+    # the machine state rebuilt from a log, printed like the assembler prints it
+    def __init__(self, state):
+        self.step = None
+        self.pc = None
+        self.load(state)
+
+    def load(self, state):
+        self.registers = Registers()
+        self.registers.data[:] = state['registers']
+        self.flags = Flags(*state['flags'])
+        self.memory = Memory()
+        self.memory.data = {address: byte for address, byte in state['memory']}
+        self.output = state['output']
+
+    def apply(self, step):
+        self.step = step['step']
+        self.pc = step['pc']
+        if 'state' in step:
+            self.load(step['state'])
+            return
+        if 'r' in step:
+            self.registers[step['r'][0]] = step['r'][1]
+        if 'm' in step:
+            self.memory[step['m'][0]] = step['m'][1]
+        if 'b' in step:
+            self.memory.store_byte(step['b'][0], step['b'][1])
+        if 'f' in step:
+            self.flags = Flags(*step['f'])
+        self.output += step.get('o', '')
+
+    def __str__(self):
+        return 'After step {} (pc {}):\n{}{}{}\nOutput Buffer:\n{}'.format(
+            self.step, self.pc, self.memory, self.registers, self.flags, self.output)
+
+
+class StepLogReader(object):
+    def __init__(self, path):
+        self.file = open(path, 'r')
+        self.initial = json.loads(self.file.readline())
+
+    def __iter__(self):
+        # the steps in order, without the initial state
+        self.file.seek(0)
+        self.file.readline()
+        for line in self.file:
+            yield json.loads(line)
+
+    def state_at(self, n=None):
+        # replays the log up to and including step n, or the whole log
+        state = StepLogState(self.initial)
+        for step in self:
+            if n is not None and step['step'] > n:
+                break
+            state.apply(step)
+        return state
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def describe(step):
+    changes = []
+    if 'state' in step:
+        changes.append('full state')
+    if 'r' in step:
+        changes.append('{} = {}'.format(REGISTER_NAMES[step['r'][0]], step['r'][1]))
+    if 'm' in step:
+        changes.append('[0x{:016X}] = {}'.format(step['m'][0] & 0xFFFFFFFFFFFFFFFF, step['m'][1]))
+    if 'b' in step:
+        changes.append('[0x{:016X}] byte = {}'.format(step['b'][0] & 0xFFFFFFFFFFFFFFFF, step['b'][1]))
+    if 'f' in step:
+        changes.append('N={} C={} Z={} V={}'.format(*step['f']))
+    if 'o' in step:
+        changes.append('output {!r}'.format(step['o']))
+    return '{:10d}: {:6d} | {}'.format(step['step'], step['pc'], ', '.join(changes))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log_file", help="name of the step log file")
+    parser.add_argument("-s", "--step", help="prints the full machine state after step N (-1 for the end)", type=int)
+    parser.add_argument("-n", help="only print the first N steps", type=int)
+    args = parser.parse_args(argv)
+    with StepLogReader(args.log_file) as log:
+        if args.step is not None:
+            print(log.state_at(None if args.step < 0 else args.step))
+            return
+        for step in log:
+            if args.n is not None and step['step'] >= args.n:
+                break
+            print(describe(step))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -22,215 +22,21 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-import sys
+import os
 
-from assembler import Assembler
-import random
+from spec_runner import SpecRunner, load_spec, print_summary
 
-def test_redloop(prog_obj, v=0):
-    # test parameters
-    input_arrays = [[2,4,3,1], [7,6,5,8]]
-    expected_output_arrays = [[2,1,3,4], [5,6,7,8]]
-    uut = 'RedLoop'
-
-    test_status_summary = []
-
-    #test loop
-    print('Beginning test for {}...'.format(uut))
-    for i in range(len(input_arrays)):
-        # preload the array into memory
-        cmd_input_array = '.long A {}'.format(', '.join(str(v) for v in input_arrays[i]))
-        prog_obj.memory.insert(cmd_input_array)
-        # pre load the array size into memory
-        cmd_input_size = '.long SIZE {}'.format(len(input_arrays[i]))
-        prog_obj.memory.insert(cmd_input_size)
-
-        # preload X0, X1
-        prog_obj.registers['X0'] = prog_obj.memory.labels['A']
-        prog_obj.registers['X1'] = len(input_arrays[i])
-
-        # run test
-        prog_obj.unit_test(uut,v)
-
-        # compose outputs
-        output_array = []
-        for j in range(len(input_arrays[i])):
-            output_array.append(prog_obj.memory[prog_obj.memory.labels['A'] + (j*8)])
-
-        # print status
-        if expected_output_arrays[i] == output_array:
-            print('\033[92m' + 'UUT: {} | Test: {} | passed'.format(uut, i+1) + '\033[0m')
-            test_status_summary.append(True)
-        else:
-            print('\033[91m' + 'UUT: {} | Test: {} | failed'.format(uut, i+1) + '\033[0m')
-            test_status_summary.append(False)
-
-        # restore memory for next test
-        prog_obj.restore()
-    return test_status_summary
-
-def test_blueloop(prog_obj, v=0):
-    # test parameters
-    input_arrays = [[2,5,6,7], [2,4,3,1,7,6,5,8]]
-    expected_output_arrays = [[2,5,6,7], [2,4,3,1,7,6,5,8]]
-    uut = 'BLueLoop'
-
-    test_status_summary = []
-
-    #test loop
-    print('Beginning test for {}...'.format(uut))
-    for i in range(len(input_arrays)):
-        # preload the array into memory
-        cmd_input_array = '.long A {}'.format(', '.join(str(v) for v in input_arrays[i]))
-        prog_obj.memory.insert(cmd_input_array)
-        # pre load the array size into memory
-        cmd_input_size = '.long SIZE {}'.format(len(input_arrays[i]))
-        prog_obj.memory.insert(cmd_input_size)
-
-        # preload X0, X1
-        prog_obj.registers['X0'] = prog_obj.memory.labels['A']
-        prog_obj.registers['X1'] = len(input_arrays[i])
-
-        # run test
-        prog_obj.unit_test(uut,v)
-
-        # compose outputs
-        output_array = []
-        for j in range(len(input_arrays[i])):
-            output_array.append(prog_obj.memory[prog_obj.memory.labels['A'] + (j*8)])
-
-        # print status
-        if expected_output_arrays[i] == output_array:
-            print('\033[92m' + 'UUT: {} | Test: {} | passed'.format(uut, i+1) + '\033[0m')
-            test_status_summary.append(True)
-        else:
-            print('\033[91m' + 'UUT: {} | Test: {} | failed'.format(uut, i+1) + '\033[0m')
-            test_status_summary.append(False)
-
-        # restore memory for next test
-        prog_obj.restore()
-    return test_status_summary
-
-def test_redrecurssion(prog_obj,v=0):
-    # test parameters
-    input_arrays = [[2,4,3,1], [7,6,5,8]]
-    expected_output_arrays = [[1,2,3,4], [5,6,7,8]]
-    uut = 'RedRecursion'
-
-    test_status_summary = []
-
-    #test loop
-    print('Beginning test for {}...'.format(uut))
-    for i in range(len(input_arrays)):
-        # preload the array into memory
-        cmd_input_array = '.long A {}'.format(', '.join(str(v) for v in input_arrays[i]))
-        prog_obj.memory.insert(cmd_input_array)
-        # pre load the array size into memory
-        cmd_input_size = '.long SIZE {}'.format(len(input_arrays[i]))
-        prog_obj.memory.insert(cmd_input_size)
-
-        # preload X0, X1
-        prog_obj.registers['X0'] = prog_obj.memory.labels['A']
-        prog_obj.registers['X1'] = len(input_arrays[i])
-
-        # run test
-        prog_obj.unit_test(uut,v)
-
-        # compose outputs
-        output_array = []
-        for j in range(len(input_arrays[i])):
-            output_array.append(prog_obj.memory[prog_obj.memory.labels['A'] + (j*8)])
-
-        # print status
-        if expected_output_arrays[i] == output_array:
-            print('\033[92m' + 'UUT: {} | Test: {} | passed'.format(uut, i+1) + '\033[0m')
-            test_status_summary.append(True)
-        else:
-            print('\033[91m' + 'UUT: {} | Test: {} | failed'.format(uut, i+1) + '\033[0m')
-            test_status_summary.append(False)
-
-        # restore memory for next test
-        prog_obj.restore()
-    return test_status_summary
-
-def test_bluerecurssion(prog_obj,v=0):
-    # test parameters
-    input_arrays = [[2,5,7,6], [2,5,7,6,8,1,3,4], [3,7,8,4,2,6,5,1], [3,7,4,8,6,2,1,5]]
-    expected_output_arrays = [[2,5,6,7], [1,2,3,4,5,6,7,8], [1,2,3,4,5,6,7,8], [1,2,3,4,5,6,7,8]]
-    uut = 'BLueRecursion'
-
-    test_status_summary = []
-
-    #test loop
-    print('Beginning test for {}...'.format(uut))
-    for i in range(len(input_arrays)):
-        # preload the array into memory
-        cmd_input_array = '.long A {}'.format(', '.join(str(v) for v in input_arrays[i]))
-        prog_obj.memory.insert(cmd_input_array)
-        # pre load the array size into memory
-        cmd_input_size = '.long SIZE {}'.format(len(input_arrays[i]))
-        prog_obj.memory.insert(cmd_input_size)
-
-        # preload X0, X1
-        prog_obj.registers['X0'] = prog_obj.memory.labels['A']
-        prog_obj.registers['X1'] = len(input_arrays[i])
-
-        # run test
-        prog_obj.unit_test(uut,v)
-
-        # compose outputs
-        output_array = []
-        for j in range(len(input_arrays[i])):
-            output_array.append(prog_obj.memory[prog_obj.memory.labels['A'] + (j*8)])
-
-        # print status
-        if expected_output_arrays[i] == output_array:
-            print('\033[92m' + 'UUT: {} | Test: {} | passed'.format(uut, i+1) + '\033[0m')
-            test_status_summary.append(True)
-        else:
-            print('\033[91m' + 'UUT: {} | Test: {} | failed'.format(uut, i+1) + '\033[0m')
-            test_status_summary.append(False)
-
-        # restore memory for next test
-        prog_obj.restore()
-    return test_status_summary
 
 def main():
-    p = open('complete_solution.txt', 'r')
-    a = Assembler(p)
-    v=1
-
-    test_summary = []
-    units_under_test = []
-
-    units_under_test.append('RedLoop')
-    units_under_test.append('BLueLoop')
-    units_under_test.append('RedRecursion')
-    units_under_test.append('BLueRecursion')
+    # the test cases for RedLoop, BLueLoop, RedRecursion and BLueRecursion
+    spec = load_spec(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bitonic-mergesort.json'))
+    with open('complete_solution.txt', 'r') as p:
+        runner = SpecRunner(p, verbose=1)
 
     print()
-    if 'RedLoop' in units_under_test:
-        test_summary.append(test_redloop(a,v))
-        print()
-
-    if 'BLueLoop' in units_under_test:
-        test_summary.append(test_blueloop(a,v))
-        print()
-    if 'RedRecursion' in units_under_test:
-        test_summary.append(test_redrecurssion(a,v))
-        print()
-    if 'BLueRecursion' in units_under_test:
-        test_summary.append(test_bluerecurssion(a,v))
-        print()
-
-    print('-------------------- Test Summary --------------------')
-    for i in range(len(test_summary)):
-        for j in range(len(test_summary[i])):
-            if test_summary[i][j]:
-                print('\033[92m' + 'UUT: {} | Test: {} | passed'.format(units_under_test[i], j+1) + '\033[0m')
-            else:
-                print('\033[91m' + 'UUT: {} | Test: {} | failed'.format(units_under_test[i], j+1) + '\033[0m')
-        print()
+    results = runner.run(spec['cases'])
+    print()
+    print_summary(results)
 
 
 if __name__ == '__main__':